@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# Estimate how much ARAM each song will take, without a trip through AddmusicK under wine.
+#   ./aram.py [SONG.txt ...]
+#   ./aram.py --check   compare against the insert sizes in descriptions.txt
+# Samples are counted exactly (they're just the .brr files), the sequence data is an estimate
+# from walking the MML and counting the bytes each command compiles to.
+import os
+import re
+import sys
+import time
+
+import build
+
+TICKS = 192  # per whole note
+MAX_TICKS = 0x7F  # longest a single note can be, longer ones are split up with ties
+INSTRUMENT_BYTES = 6  # each #instruments entry: sample, ADSR/GAIN and tuning
+PATTERN_BYTES = 16  # a pointer for each of the 8 channels
+SONG_BYTES = 4  # end of the pattern list, and the pointer it loops back to
+SAMPLE_DIR_BYTES = 4  # start and loop pointers in the sample directory
+# whatever else AddmusicK adds that isn't accounted for above: the average difference from the
+# insert sizes that were actually submitted (in descriptions.txt, see --check)
+UNACCOUNTED = 72
+GROUPS_FILE = "Addmusic_sample groups.txt"
+
+re_header = re.compile(r"\#(?:amk\s+\d+|path\s*\"[^\"]*\"|halvetempo|spc\s*\{[^{}]*\}|samples\s*\{[^{}]*\}|instruments\s*\{[^{}]*\})", re.IGNORECASE)
+re_token = re.compile(r"""\s*(?:
+	(?P<note>[a-g][+-]*|r)(?P<length>=\d+|\d+)?(?P<dots>\.*)
+	| \^(?P<tielength>=\d+|\d+)?(?P<tiedots>\.*)
+	| \$(?P<hex>[0-9A-Fa-f]{2})
+	| \#(?P<channel>[0-7])
+	| \((?P<label>\d+)\)(?P<define>\[)?(?P<callcount>\d+)?
+	| (?P<superstart>\[\[) | \]\](?P<supercount>\d+)?
+	| (?P<loopstart>\[) | \](?P<loopcount>\d+)?
+	| (?P<cmd>[@vywt])(?P<args>\d+(?:,\d+)*)
+	| p(?P<vibrato>\d+(?:,\d+)*)
+	| l(?P<default>=\d+|\d+)(?P<defaultdots>\.*)
+	| q(?P<quant>[0-9A-Fa-f]{2})
+	| n(?P<noise>[0-9A-Fa-f]{1,2})
+	| o(?P<octave>\d) | h(?P<transpose>-?\d+) | (?P<shift>[<>])
+	| (?P<triplet>[{}])
+	| (?P<intro>/)
+	)""", re.VERBOSE)
+
+def note_ticks(length, dots, default, triplet, halvetempo):
+	# how long a note, rest or tie is, in ticks; #halvetempo halves the tempo and every length with
+	# it, so the song plays at the same speed (see spcrender.py, which needs to agree)
+	if not length:
+		ticks = default
+	elif length.startswith("="):
+		ticks = int(length[1:])
+	else:
+		ticks = TICKS // int(length)
+	add = ticks
+	for _ in dots:
+		add //= 2
+		ticks += add
+	if triplet:
+		ticks = ticks * 2 // 3
+	if halvetempo:
+		ticks //= 2
+	return ticks
+
+class SequenceEstimate:
+	def __init__(self, halvetempo=False):
+		self.size = 0
+		self.patterns = 1
+		self.halvetempo = halvetempo
+		self.channel = None
+		self.reset()
+
+	def reset(self):
+		self.default = TICKS // 8
+		self.triplet = False
+		self.last_length = None
+		self.quant = False
+		self.pending = None
+
+	def ticks(self, length, dots):
+		return note_ticks(length, dots, self.default, self.triplet, self.halvetempo)
+
+	def flush(self):
+		# a note (and any ties right after it) goes out as one length, split up if it's too long,
+		# with the length byte only written when it changes
+		if self.pending is None:
+			return
+		ticks, self.pending = self.pending, None
+		pieces = -(-ticks // MAX_TICKS)
+		if ticks % pieces == 0:
+			lengths = [ticks // pieces] * pieces
+		else:
+			lengths = [MAX_TICKS] * (pieces - 1) + [ticks - MAX_TICKS * (pieces - 1)]
+		for length in lengths:
+			if length != self.last_length or self.quant:
+				self.size += 1 + self.quant
+				self.last_length = length
+				self.quant = False
+			self.size += 1
+
+	def boundary(self):
+		# loops and calls are compiled separately, so nothing carries across them
+		self.flush()
+		self.last_length = None
+
+	def feed(self, text):
+		pos = 0
+		while pos < len(text):
+			if text[pos:].isspace():
+				break
+			m = re_token.match(text, pos)
+			if not m:
+				line = text.count("\n", 0, pos) + 1
+				raise ValueError(f"Can't parse MML at line {line}: {text[pos:pos + 20]!r}")
+			pos = m.end()
+			self.token(m)
+		self.boundary()
+		if self.channel is not None:
+			self.size += 1
+
+	def token(self, m):
+		if m["note"]:
+			self.flush()
+			self.pending = self.ticks(m["length"], m["dots"])
+			return
+		if m.group().strip().startswith("^"):
+			ticks = self.ticks(m["tielength"], m["tiedots"])
+			if self.pending is None:
+				self.pending = 0
+			self.pending += ticks
+			return
+		self.flush()
+		if m["hex"]:
+			self.size += 1
+		elif m["channel"]:
+			if self.channel is not None:
+				self.size += 1
+			self.channel = int(m["channel"])
+			self.reset()
+		elif m["label"]:
+			# a labelled loop, or a call to one; either way the call itself is 4 bytes
+			self.boundary()
+			self.size += 4
+		elif m["superstart"] or m.group().strip().startswith("]]"):
+			self.boundary()
+			self.size += 2
+		elif m["loopstart"]:
+			self.boundary()
+			self.size += 4
+		elif m.group().strip().startswith("]"):
+			# end of the loop body
+			self.boundary()
+			self.size += 1
+		elif m["cmd"]:
+			self.size += 3 if m["cmd"] in "vwt" and "," in m["args"] else 2
+		elif m["vibrato"]:
+			self.size += 1 if m["vibrato"].split(",")[-1] == "0" else 4
+		elif m["default"]:
+			# not halved yet, that happens when it's used
+			self.default = note_ticks(m["default"], m["defaultdots"], self.default, self.triplet, False)
+		elif m["quant"]:
+			self.quant = True
+		elif m["noise"]:
+			self.size += 2
+		elif m["triplet"]:
+			self.triplet = m["triplet"] == "{"
+		elif m["intro"]:
+			self.boundary()
+			self.patterns = 2
+
+def strip_mml(dat):
+	dat = re.sub(r";.*", "", dat)
+	return re_header.sub("", dat)
+
+def sequence_size(dat):
+	halvetempo = "#halvetempo" in dat.lower()
+	instruments = build.re_instruments.search(dat)
+	ninstruments = len([i for i in instruments.group(1).split("\n") if i.strip() and not i.strip().startswith(";")]) if instruments else 0
+	estimate = SequenceEstimate(halvetempo)
+	estimate.feed(strip_mml(dat))
+	return estimate.size + ninstruments * INSTRUMENT_BYTES + estimate.patterns * (PATTERN_BYTES + 2) + SONG_BYTES + UNACCOUNTED
+
+def read_sample(fn):
+	# the loop header isn't loaded into ARAM, its loop point goes in the sample directory instead
+	with open(fn, "rb") as fp:
+		header = fp.read(2)
+		return header, fp.read()
+
+_group_cache = {}
+def group_samples(name):
+	# the sample groups are defined by AddmusicK itself, so they can only be counted if it's there
+	if name not in _group_cache:
+		res = None
+		groups = os.path.join(build.AMK, GROUPS_FILE)
+		if os.path.exists(groups):
+			with open(groups) as fp:
+				match = re.search(r"\#" + name + r"\s*\{([^{}]*)\}", fp.read(), re.IGNORECASE)
+			if match:
+				res = [os.path.join(build.AMK, "samples", i) for i in re.findall(r"\"([^\"]*)\"", match.group(1))]
+		_group_cache[name] = res
+	return _group_cache[name]
+
+def sample_size(dat):
+	# returns the size of the song's own samples, and of the AddmusicK sample group (None if unknown)
+	match = build.re_samples.search(dat)
+	if not match:
+		return 0, 0
+	own = []
+	group = []
+	for i in match.group(1).split("\n"):
+		i = i.strip()
+		if not i:
+			continue
+		if i.startswith("#"):
+			fns = group_samples(i[1:])
+			if fns is None:
+				group = None
+			elif group is not None:
+				group.extend(fns)
+		else:
+			own.append(os.path.join("inst", i.strip('"')))
+	# AddmusicK only loads a sample once, however many times it's asked for it
+	seen = set()
+	def total(fns):
+		res = 0
+		for fn in fns:
+			header, data = read_sample(fn)
+			if (header, data) in seen:
+				continue
+			seen.add((header, data))
+			res += len(data) + SAMPLE_DIR_BYTES
+		return res
+	groupsize = None if group is None else total(group)
+	return total(own), groupsize
+
+def estimate(song):
+	with open(f"txt/{song}") as fp:
+		dat = fp.read()
+	own, group = sample_size(dat)
+	return sequence_size(dat), own, group
+
+def read_descriptions():
+	# the insert sizes AddmusicK reported, as submitted, in the same order as the songs
+	with open("descriptions.txt") as fp:
+		return [int(i, 16) for i in re.findall(r"Insert Size: ([0-9A-Fa-f]+)", fp.read())]
+
+def check():
+	songs = build.get_songs()
+	errors = []
+	for song, actual in zip(songs, read_descriptions()):
+		with open(f"txt/{song}") as fp:
+			seq = sequence_size(fp.read())
+		errors.append(seq - actual)
+		print(f"{song:40s} estimate 0x{seq:04X}, actual 0x{actual:04X} ({seq - actual:+d})")
+	print(f"Mean error {sum(errors) / len(errors):+.1f}, worst {max(errors, key=abs):+d}")
+
+def main():
+	build.init()
+	if "--check" in sys.argv:
+		check()
+		return
+	songs = sys.argv[1:] or build.get_songs()
+	start = time.perf_counter()
+	results = {song: estimate(song) for song in songs}
+	elapsed = time.perf_counter() - start
+	for song, (seq, own, group) in results.items():
+		print(song)
+		print(f"  Sequence size: ~0x{seq:04X} (~{seq:,})")
+		print(f"  Samples size: 0x{own:04X} ({own:,})" + ("" if group is not None else " + default samples"))
+		if group is not None:
+			print(f"  Default samples size: 0x{group:04X} ({group:,})")
+		print()
+	print(f"{len(songs)} songs in {elapsed * 1000:.1f}ms")
+
+if __name__ == "__main__":
+	main()
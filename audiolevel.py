@@ -1,22 +1,42 @@
 #!/usr/bin/python
 import glob
+import hashlib
 import subprocess
 import math
 import sys
 import os
 import re
-from build import build_songs, AMK
+from concurrent.futures import ProcessPoolExecutor
+from build import build_songs, get_samples, AMK
+import loudness
+import spcrender
 
+# NB: these two are still from wavegain (ReplayGain 1), not loudness.py's R128 meter that the
+# volumes they're compared against are measured with now, so every scale worked out from them is
+# off by however much the two meters disagree. ./audiolevel.py --calibrate works out what they
+# should be with the new meter (it needs the out/*/full.wav recordings), and until they're
+# replaced with what that says, SCALES_METER stays "wavegain" and there's a warning to go with it
 TARGET_SCALE = 1/1.7871  # from running wavegain --album on the original SMW music
 ADJ_SCALE = 1/1.0320  # from running wavegain --album on the out/*/full.wav files
+SCALES_METER = "wavegain"
+# measure the songs by rendering them with spcrender.py, rather than building them with AddmusicK
+# and recording the SPCs through mpv (--record goes back to doing that)
+RECORD = False
+# how much louder a recording from mpv comes out than spcrender.py's render of the same song
+RENDER_SCALE = 1.0
+# for --solve: how close to the target each song has to get, and how many goes it gets to do it
+TOLERANCE_DB = 0.1
+MAX_ITERATIONS = 8
+# and write the w levels it settles on back into the text files
+WRITE = False
+CACHE = "tmp/wlevel"
 
 def measure_vol(fn):
-	ret = subprocess.check_output(["wavegain", "--calculate", "--scale", fn])
-	# the scale value is what the sound should be _multiplied by_ to reach some target volume
-	# so if we invert it, it'll be a number that represents the current volume
-	# ie higher = louder
-	# easier to reason about later
-	return 1 / float(ret.decode("ascii"))
+	# a number that represents the current volume, ie higher = louder
+	# (this used to be the inverse of the scale from wavegain --calculate --scale, which is what
+	# the sound should be _multiplied by_ to reach the target volume; loudness.py measures on the
+	# same scale, and caches it, since the source recordings never change)
+	return loudness.measure_vol(fn)
 
 def record_song(fnin, fnout):
 	subprocess.check_call(["mpv", "--ao=pcm", f"--ao-pcm-file={fnout}", fnin])
@@ -30,12 +50,59 @@ def measure_src_vols(target=None):
 		res[ix] = measure_vol(fn)
 	return res
 
+re_w_lvl = re.compile(r"w(\d+)")
 def get_w_lvl(fn):
 	with open(fn) as fp:
 		dat = fp.read()
-	match = re.search(r"w(\d+)", dat)
+	match = re_w_lvl.search(dat)
 	return int(match.group(1))
 
+def set_w_lvl(fn, w_lvl):
+	with open(fn) as fp:
+		dat = fp.read()
+	with open(fn, "w") as fp:
+		fp.write(re_w_lvl.sub(f"w{w_lvl}", dat, count=1))
+
+def render_vol(fn, w_lvl=None):
+	with open(fn) as fp:
+		pcm = spcrender.render_song(fp.read(), master=w_lvl)
+	return loudness.to_vol(loudness.integrated_loudness(pcm, spcrender.RATE)) * RENDER_SCALE
+
+def level_key(fn):
+	# everything the volume depends on, other than the w level: the song, with its w taken out,
+	# the samples it uses, and what's doing the measuring
+	with open(fn) as fp:
+		dat = fp.read()
+	h = hashlib.sha256()
+	h.update(re_w_lvl.sub("w", dat, count=1).encode("utf-8"))
+	for sample in get_samples(dat):
+		h.update(sample.encode("utf-8"))
+		with open(f"inst/{sample}", "rb") as fp:
+			h.update(fp.read())
+	h.update(b"record" if RECORD else f"render {spcrender.VERSION}".encode("utf-8"))
+	return h.hexdigest()
+
+def measure_at(fn, w_lvl):
+	# the song's volume with the given w level, only rendering (or building and recording) it if
+	# that's not been measured before
+	cachefn = os.path.join(CACHE, f"{level_key(fn)}.{w_lvl}")
+	if os.path.exists(cachefn):
+		with open(cachefn) as fp:
+			return float(fp.read())
+	if RECORD:
+		song = os.path.basename(fn)
+		set_w_lvl(fn, w_lvl)
+		build_songs([song])
+		tmpfn = f"tmp/full_{song[:2]}.wav"
+		record_song(f"{AMK}/SPCs/{song[:-4]}.spc", tmpfn)
+		vol = measure_vol(tmpfn)
+	else:
+		vol = render_vol(fn, w_lvl)
+	os.makedirs(CACHE, exist_ok=True)
+	with open(cachefn, "w") as fp:
+		print(repr(vol), file=fp)
+	return vol
+
 def measure_dst_vols(target=None):
 	songs = {}
 	for fn in sorted(glob.glob("txt/*.txt")):
@@ -43,6 +110,10 @@ def measure_dst_vols(target=None):
 		if target is not None and ix not in target:
 			continue
 		songs[ix] = os.path.basename(fn)
+	if not RECORD:
+		with ProcessPoolExecutor() as pool:
+			vols = pool.map(render_vol, [f"txt/{fn}" for fn in songs.values()])
+			return {ix: (vol, get_w_lvl(f"txt/{fn}")) for (ix, fn), vol in zip(songs.items(), vols)}
 	build_songs(songs.values())
 	res = {}
 	for ix, fn in songs.items():
@@ -59,21 +130,114 @@ def calc_adjustments(target=None):
 	return {
 		ix: (scale, w_lvl, dst[ix][1])
 		for ix in src.keys()
-		for scale in [TARGET_SCALE * (src[ix] / ADJ_SCALE) / dst[ix][0]]
-		for w_lvl in [min(round(dst[ix][1] * math.sqrt(scale)), 255)]
+		# a song that comes out silent has no scale that'll fix it
+		for scale in [TARGET_SCALE * (src[ix] / ADJ_SCALE) / dst[ix][0] if dst[ix][0] else None]
+		for w_lvl in [min(round(dst[ix][1] * math.sqrt(scale)), 255) if scale else None]
 	}
 
+def calibrate(target=None):
+	# TARGET_SCALE and ADJ_SCALE as loudness.py measures them: ADJ_SCALE is the album volume of
+	# the source recordings, like it was with wavegain --album, and TARGET_SCALE is whatever makes
+	# the w levels the songs have now come out right on average (the original SMW music that it
+	# came from before isn't to hand to measure again)
+	fns = sorted(fn for fn in glob.glob("out/*/full.wav") if target is None or int(fn[4:6]) in target)
+	if not fns:
+		print("No out/*/full.wav recordings to calibrate against")
+		return
+	adj_scale = loudness.to_vol(loudness.album_loudness(fns))
+	src = measure_src_vols(target)
+	dst = measure_dst_vols(target)
+	ratios = [math.log(dst[ix][0] / src[ix]) for ix in src if dst[ix][0]]
+	target_scale = adj_scale * math.exp(sum(ratios) / len(ratios))
+	print(f"TARGET_SCALE = 1/{1 / target_scale:.4f}  # was 1/{1 / TARGET_SCALE:.4f}")
+	print(f"ADJ_SCALE = 1/{1 / adj_scale:.4f}  # was 1/{1 / ADJ_SCALE:.4f}")
+	print('SCALES_METER = "r128"')
+
+def warn_scales():
+	if SCALES_METER != "r128":
+		print(f"NB: TARGET_SCALE and ADJ_SCALE are from {SCALES_METER}, not the R128 meter, so these are all off by the same amount (see --calibrate)")
+
 def to_db(scale):
 	return math.log10(scale) * 20
 
+def solve_song(fn, wanted, tolerance=TOLERANCE_DB):
+	# keep nudging w until the song measures as loud as we want it, or it can't get any closer
+	# (w only goes in whole steps), returning the best w, its error, and all the w levels tried
+	# (or None for the w and its error, if the song comes out silent, since then no w will do)
+	old_w_lvl = w_lvl = get_w_lvl(fn)
+	tried = {}
+	try:
+		for _ in range(MAX_ITERATIONS):
+			vol = measure_at(fn, w_lvl)
+			if not vol:
+				return None, None, tried
+			tried[w_lvl] = to_db(wanted / vol)
+			if abs(tried[w_lvl]) <= tolerance:
+				break
+			# the volume goes with the square of w
+			new_w_lvl = max(1, min(round(w_lvl * 10 ** (tried[w_lvl] / 40)), 255))
+			if new_w_lvl in tried:
+				break
+			w_lvl = new_w_lvl
+	finally:
+		if RECORD:
+			# recording has to change the file to try each w, so put it back, however this ends
+			set_w_lvl(fn, old_w_lvl)
+	best = min(tried, key=lambda i: abs(tried[i]))
+	return best, tried[best], tried
+
+def solve(target=None, tolerance=TOLERANCE_DB):
+	src = measure_src_vols(target)
+	songs = sorted(fn for fn in glob.glob("txt/*.txt") if int(fn[4:6]) in src)
+	wanted = [TARGET_SCALE * src[int(fn[4:6])] / ADJ_SCALE for fn in songs]
+	old = [get_w_lvl(fn) for fn in songs]
+	if RECORD:
+		# every measurement is a trip through AddmusicK, so one at a time
+		results = list(map(solve_song, songs, wanted, [tolerance] * len(songs)))
+	else:
+		with ProcessPoolExecutor() as pool:
+			results = list(pool.map(solve_song, songs, wanted, [tolerance] * len(songs)))
+	print()
+	print("=====")
+	print()
+	for fn, old_w_lvl, (w_lvl, err, tried) in zip(songs, old, results):
+		if w_lvl is None:
+			print(f"{fn[4:6]}: w{old_w_lvl:d}  comes out silent, can't be solved")
+			continue
+		print(f"{fn[4:6]}: w{old_w_lvl:d} -> w{w_lvl:d}  {err:+.3f}dB  ({len(tried)} tried){'  GOOD' if w_lvl == old_w_lvl else ''}")
+		if WRITE:
+			set_w_lvl(fn, w_lvl)
+	warn_scales()
+
 def main(target=None):
 	vals = calc_adjustments(target)
 	print()
 	print("=====")
 	print()
 	for ix, (scale, w_lvl, old_w_lvl) in sorted(vals.items()):
+		if scale is None:
+			print(f"{ix:02d}: comes out silent, can't be adjusted")
+			continue
 		print(f"{ix:02d}: {to_db(scale):+.3f}dB  x{scale:.3f}  w{w_lvl:d}{'  GOOD' if w_lvl == old_w_lvl else ''}")
+	warn_scales()
 
 if __name__ == "__main__":
+	if "--record" in sys.argv:
+		sys.argv.remove("--record")
+		RECORD = True
+	solving = "--solve" in sys.argv
+	if solving:
+		sys.argv.remove("--solve")
+	calibrating = "--calibrate" in sys.argv
+	if calibrating:
+		sys.argv.remove("--calibrate")
+	if "--write" in sys.argv:
+		sys.argv.remove("--write")
+		WRITE = True
 	target = {int(i) for i in sys.argv[1:]} if len(sys.argv) > 1 else None
-	main(target)
+	if calibrating:
+		calibrate(target)
+	elif solving:
+		solve(target)
+	else:
+		main(target)
@@ -0,0 +1,151 @@
+import struct
+
+import numpy as np
+
+# BRR encoder/decoder, standing in for brr_encoder.exe/brr_decoder.exe from BRRtools.
+# https://wiki.superfamicom.org/bit-rate-reduction-(brr)
+# The decoding maths follows the S-DSP exactly (as per blargg's snes_spc), since the
+# encoder has to predict exactly what the hardware will reconstruct.
+#
+# Each 9-byte block is a header (shift << 4 | filter << 2 | loop << 1 | end) followed by
+# 16 signed 4-bit samples, high nibble first. Like BRRtools, the output starts with one
+# block of silence so the filters have a clean history, and a looping sample has the loop
+# flag on every block, that one included.
+
+BLOCK_SAMPLES = 16
+BLOCK_BYTES = 9
+MAX_SHIFT = 12  # 13-15 are not useful
+QUALITY_BEAM = 16
+
+def _predict(filt, p1, p2):
+	# p1 is the previous output sample, p2 the one before; outputs are stored doubled
+	p2 = p2 >> 1
+	pred1 = (p1 >> 1) + ((-p1) >> 5)
+	pred2 = p1 - p2 + (p2 >> 4) + ((p1 * -3) >> 6)
+	pred3 = p1 - p2 + ((p1 * -13) >> 7) + ((p2 * 3) >> 4)
+	return np.choose(filt, [np.zeros_like(p1), pred1, pred2, pred3])
+
+def _encode_block(block, p1, p2, filt, shift):
+	# try every candidate (filter, shift, starting history) against one block at once
+	ncand = len(filt)
+	nibbles = np.empty((ncand, BLOCK_SAMPLES), dtype=np.int64)
+	err = np.zeros(ncand, dtype=np.int64)
+	scale = 2.0 ** shift
+	for i in range(BLOCK_SAMPLES):
+		pred = _predict(filt, p1, p2)
+		target = int(block[i])
+		n = np.clip(np.round((target - 2 * pred) / scale), -8, 7).astype(np.int64)
+		s = np.clip(((n << shift) >> 1) + pred, -32768, 32767)
+		# doubling wraps around as a signed 16-bit value, which is the classic BRR overflow glitch
+		out = ((s * 2 + 32768) & 0xFFFF) - 32768
+		err += (out - target) ** 2
+		nibbles[:, i] = n
+		p2 = p1
+		p1 = out
+	return nibbles, err, p1, p2
+
+def encode(samples, loop=False, quality=False, beam=None):
+	# samples: 16-bit PCM, padded with silence to a whole number of blocks
+	# quality searches a beam of the best encodings so far instead of committing to the best one block by block
+	samples = np.asarray(samples, dtype=np.int64)
+	if len(samples) % BLOCK_SAMPLES:
+		samples = np.concatenate([samples, np.zeros(BLOCK_SAMPLES - len(samples) % BLOCK_SAMPLES, dtype=np.int64)])
+	blocks = samples.reshape(-1, BLOCK_SAMPLES)
+	if beam is None:
+		beam = QUALITY_BEAM if quality else 1
+
+	filters = np.repeat(np.arange(4), MAX_SHIFT + 1)
+	shifts = np.tile(np.arange(MAX_SHIFT + 1), 4)
+	ncand = len(filters)
+
+	p1 = np.zeros(1, dtype=np.int64)
+	p2 = np.zeros(1, dtype=np.int64)
+	total = np.zeros(1, dtype=np.int64)
+	history = []
+	for block in blocks:
+		nstate = len(p1)
+		parent = np.repeat(np.arange(nstate), ncand)
+		filt = np.tile(filters, nstate)
+		shift = np.tile(shifts, nstate)
+		nibbles, err, newp1, newp2 = _encode_block(block, p1[parent], p2[parent], filt, shift)
+		err += total[parent]
+		if beam == 1:
+			keep = np.array([np.argmin(err)])
+		else:
+			keep = np.argsort(err, kind="stable")[:beam]
+		history.append((parent[keep], filt[keep], shift[keep], nibbles[keep]))
+		p1 = newp1[keep]
+		p2 = newp2[keep]
+		total = err[keep]
+
+	# walk back from the best final state to recover the chosen encoding of each block
+	chosen = []
+	ix = 0
+	for parent, filt, shift, nibbles in reversed(history):
+		chosen.append((int(filt[ix]), int(shift[ix]), nibbles[ix]))
+		ix = parent[ix]
+	chosen.reverse()
+
+	res = bytearray(BLOCK_BYTES * (len(chosen) + 1))
+	flags = 2 if loop else 0
+	res[0] = flags
+	for i, (filt, shift, nibbles) in enumerate(chosen):
+		pos = (i + 1) * BLOCK_BYTES
+		last = i == len(chosen) - 1
+		res[pos] = shift << 4 | filt << 2 | flags | (1 if last else 0)
+		packed = ((nibbles[0::2] & 0xF) << 4) | (nibbles[1::2] & 0xF)
+		res[pos + 1:pos + BLOCK_BYTES] = packed.astype(np.uint8).tobytes()
+	if not chosen:
+		res[0] |= 1
+	return bytes(res)
+
+def decode(data, loop_block=None, loops=1):
+	# decode to 16-bit PCM; a looping sample plays the loop the given number of times
+	nblocks = len(data) // BLOCK_BYTES
+	res = []
+	p1 = p2 = 0
+	block = 0
+	remaining = loops
+	while block < nblocks:
+		pos = block * BLOCK_BYTES
+		header = data[pos]
+		shift = header >> 4
+		filt = (header >> 2) & 3
+		for byte in data[pos + 1:pos + BLOCK_BYTES]:
+			for n in (byte >> 4, byte & 0xF):
+				if n >= 8:
+					n -= 16
+				s = (n << shift) >> 1
+				if shift >= 13:
+					s = -2048 if n < 0 else 0
+				h2 = p2 >> 1
+				if filt == 1:
+					s += (p1 >> 1) + ((-p1) >> 5)
+				elif filt == 2:
+					s += p1 - h2 + (h2 >> 4) + ((p1 * -3) >> 6)
+				elif filt == 3:
+					s += p1 - h2 + ((p1 * -13) >> 7) + ((h2 * 3) >> 4)
+				s = max(-32768, min(32767, s))
+				s = ((s * 2 + 32768) & 0xFFFF) - 32768
+				res.append(s)
+				p2 = p1
+				p1 = s
+		block += 1
+		if header & 1:
+			remaining -= 1
+			if header & 2 and loop_block is not None and remaining > 0:
+				block = loop_block
+			else:
+				break
+	return np.array(res, dtype=np.int16)
+
+def write_brr(fn, data, loop_block=None):
+	# the layout AddmusicK wants: loop offset in bytes, then the blocks
+	with open(fn, "wb") as fp:
+		fp.write(struct.pack("<H", 0 if loop_block is None else loop_block * BLOCK_BYTES) + data)
+
+def read_brr(fn):
+	with open(fn, "rb") as fp:
+		loop_ofs, = struct.unpack("<H", fp.read(2))
+		data = fp.read()
+	return data, loop_ofs // BLOCK_BYTES
@@ -4,10 +4,16 @@ import glob
 import os.path
 import subprocess
 import re
-import zipfile
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import read_manifest
+import zipcache
 
 TOP=os.path.dirname(__file__)
 AMK="/home/phlip/smwhack/AddmusicK_1.0.11"
+# rebuild every song, even the ones that haven't changed since last time
+FORCE = False
 
 def init():
 	os.chdir(TOP)
@@ -18,6 +24,46 @@ def get_songs():
 	os.chdir(TOP)
 	return sorted(os.path.basename(i) for i in glob.glob("txt/*.txt"))
 
+def song_key(song):
+	# everything a song's build depends on: the song file and the samples it pulls in
+	with open(f"txt/{song}") as fp:
+		dat = fp.read()
+	h = hashlib.sha256()
+	h.update(dat.encode("utf-8"))
+	for sample in get_samples(dat):
+		h.update(sample.encode("utf-8"))
+		with open(f"inst/{sample}", "rb") as fp:
+			h.update(fp.read())
+	return h.hexdigest()
+
+def read_cache(song):
+	# the key the song was last built with, and the stats from that build
+	try:
+		with open(f"build/cache/{song}") as fp:
+			key, insert, samples, length = fp.read().split()
+	except (FileNotFoundError, ValueError):
+		return None, None
+	return key, (int(insert), int(samples), int(length))
+
+def write_cache(song, key, stats):
+	os.makedirs("build/cache", exist_ok=True)
+	with open(f"build/cache/{song}", "w") as fp:
+		print(key, *stats, file=fp)
+
+def find_stale(songs):
+	# returns the songs that need building, and the stats we already have for the rest
+	os.chdir(TOP)
+	stale = {}
+	cached = {}
+	for song in songs:
+		key = song_key(song)
+		oldkey, stats = read_cache(song)
+		if FORCE or key != oldkey or not os.path.exists(f"{AMK}/SPCs/{song[:-4]}.spc"):
+			stale[song] = key
+		else:
+			cached[song] = stats
+	return stale, cached
+
 def build_songs(songs):
 	os.chdir(AMK)
 	subprocess.check_call(["wine", "AddmusicK.exe", "-v", "-noblock", "-norom", *(f"eternalchampions/{i}" for i in songs)])
@@ -63,34 +109,45 @@ def do_write_stats(songs, stats, fp):
 
 def get_instrument_data():
 	os.chdir(TOP)
-	ret = subprocess.check_output(["./inst.py", "--skip"]).decode("utf-8")
-	return set(i.strip() for i in ret.split("\n") if i.strip())
+	return set(sample.tuning() for sample in read_manifest())
+
+def zip_members(song, inst_dat):
+	assert song.endswith(".txt")
+	insts = get_instruments(song, inst_dat)
+	return [
+		(f"txt/{song}", f"eternalchampions-{song}"),
+		(f"{AMK}/SPCs/{song[:-4]}.spc", f"eternalchampions-{song[:-4]}.spc"),
+		*((f"inst/{inst}", f"eternalchampions/{inst}") for inst in insts),
+	]
+
+def write_zip(song, members):
+	zipcache.write_zip(f"build/eternalchampions-{song[:-4]}.zip", members)
 
 def write_zips(songs, inst_dat):
 	os.chdir(TOP)
-	for song in songs:
-		assert song.endswith(".txt")
-		zipfn = f"build/eternalchampions-{song[:-4]}.zip"
-		insts = get_instruments(song, inst_dat)
-		with zipfile.ZipFile(zipfn, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zfp:
-			zfp.write(f"txt/{song}", f"eternalchampions-{song}")
-			zfp.write(f"{AMK}/SPCs/{song[:-4]}.spc", f"eternalchampions-{song[:-4]}.spc")
-			for inst in insts:
-				zfp.write(f"inst/{inst}", f"eternalchampions/{inst}")
+	members = {song: zip_members(song, inst_dat) for song in songs}
+	with ProcessPoolExecutor() as pool:
+		# compress each file just the once, before they get shared out between the archives
+		unique = sorted({fn for song in songs for fn, arcname in members[song]})
+		list(pool.map(zipcache.prime, unique))
+		list(pool.map(write_zip, songs, [members[song] for song in songs]))
 
 re_samples = re.compile(r"\#samples\s*\{\s*([^{}]*?)\s*\}", re.IGNORECASE | re.DOTALL)
 re_instruments = re.compile(r"\#instruments\s*\{\s*([^{}]*?)\s*\}", re.IGNORECASE | re.DOTALL)
-def get_instruments(song, inst_dat):
-	with open(f"txt/{song}") as fp:
-		dat = fp.read()
-
+def get_samples(dat):
 	match = re_samples.search(dat)
 	assert match
 	samples = match.group(1)
 	samples = [i.strip() for i in samples.split("\n") if i.strip()]
 	samples.remove("#optimized")
 	assert all(i.startswith('"') and i.endswith('"') for i in samples)
-	samples = [i[1:-1] for i in samples]
+	return [i[1:-1] for i in samples]
+
+def get_instruments(song, inst_dat):
+	with open(f"txt/{song}") as fp:
+		dat = fp.read()
+
+	samples = get_samples(dat)
 
 	match = re_instruments.search(dat)
 	assert match
@@ -107,11 +164,19 @@ def get_instruments(song, inst_dat):
 def main():
 	init()
 	songs = get_songs()
-	build_songs(songs)
-	stats = read_stats(songs)
+	stale, stats = find_stale(songs)
+	if stale:
+		build_songs(list(stale))
+		fresh = read_stats(list(stale))
+		os.chdir(TOP)
+		for song, key in stale.items():
+			write_cache(song, key, fresh[song])
+		stats.update(fresh)
 	write_stats(songs, stats)
 	inst_dat = get_instrument_data()
 	write_zips(songs, inst_dat)
 
 if __name__ == "__main__":
+	if "--force" in sys.argv:
+		FORCE = True
 	main()
@@ -0,0 +1,127 @@
+import wave
+from math import ceil
+
+import numpy as np
+
+# In-process versions of the sox operations inst.py used to shell out for.
+# Samples are float64 in [-1, 1), shape (frames,) for mono or (frames, channels).
+
+class ClippingError(Exception):
+	pass
+
+def read_wav(fn):
+	with wave.open(fn, "rb") as fp:
+		if fp.getsampwidth() != 2:
+			raise ValueError(f"{fn}: only 16-bit wav files are supported")
+		nchannels = fp.getnchannels()
+		rate = fp.getframerate()
+		dat = fp.readframes(fp.getnframes())
+	samples = np.frombuffer(dat, dtype="<i2").reshape(-1, nchannels) / 32768
+	return samples, rate
+
+def to_pcm16(samples, label="output"):
+	pcm = np.round(samples * 32768)
+	clipped = np.count_nonzero((pcm > 32767) | (pcm < -32768))
+	if clipped:
+		raise ClippingError(f"{label}: {clipped} samples clipped")
+	return pcm.astype("<i2")
+
+def write_wav(fn, samples, rate):
+	pcm = to_pcm16(samples, fn)
+	with wave.open(fn, "wb") as fp:
+		fp.setnchannels(1 if pcm.ndim == 1 else pcm.shape[1])
+		fp.setsampwidth(2)
+		fp.setframerate(round(rate))
+		fp.writeframes(pcm.tobytes())
+
+def mix_mono(samples):
+	# same as sox "channels 1": average all the channels together
+	if samples.ndim == 1:
+		return samples
+	return samples.mean(axis=1)
+
+def gain(samples, db):
+	return samples * 10 ** (db / 20)
+
+# Windowed-sinc kernel, tabulated at OVERSAMPLE points per zero crossing and linearly
+# interpolated between them, so it can be evaluated at any fractional phase. This is
+# the usual polyphase arrangement for resampling by a non-rational ratio, which is what
+# we need since the rates get rounded to fit whole BRR blocks.
+ZERO_CROSSINGS = 32
+OVERSAMPLE = 512
+KAISER_BETA = 9.0
+PASSBAND = 0.95
+
+_kernel_cache = {}
+def _kernel(zero_crossings, oversample, beta):
+	key = zero_crossings, oversample, beta
+	if key not in _kernel_cache:
+		x = np.arange(zero_crossings * oversample + 2) / oversample
+		table = np.sinc(x) * np.kaiser(2 * len(x) - 1, beta)[len(x) - 1:]
+		table[-2:] = 0
+		_kernel_cache[key] = table
+	return _kernel_cache[key]
+
+def resample(samples, inrate, outrate, length=None, zero_crossings=ZERO_CROSSINGS, oversample=OVERSAMPLE, beta=KAISER_BETA):
+	# output sample n is the input evaluated at n * inrate / outrate, so the two stay aligned at 0
+	# length limits how much output we bother computing
+	if samples.ndim != 1:
+		return np.stack([resample(samples[:, ch], inrate, outrate, length, zero_crossings, oversample, beta) for ch in range(samples.shape[1])], axis=1)
+	step = inrate / outrate
+	if length is None or length > round(len(samples) / step):
+		length = round(len(samples) / step)
+	# when downsampling, stretch the kernel to cut off below the new Nyquist frequency
+	cutoff = min(1.0, 1 / step) * PASSBAND
+	halfwidth = zero_crossings / cutoff
+	ntaps = 2 * ceil(halfwidth) + 1
+	table = _kernel(zero_crossings, oversample, beta)
+	padded = np.concatenate([np.zeros(ntaps), samples, np.zeros(ntaps)])
+	out = np.empty(length)
+	taps = np.arange(ntaps) - ntaps // 2
+	# keep the working arrays to a sensible size
+	chunk = max(64, (1 << 20) // ntaps)
+	for base in range(0, length, chunk):
+		n = np.arange(base, min(base + chunk, length))
+		pos = n * step
+		ipos = np.floor(pos).astype(np.int64)
+		frac = pos - ipos
+		# distance from each output point to each tap, in input samples, scaled into zero crossings
+		dist = np.abs(taps[None, :] - frac[:, None]) * cutoff * oversample
+		idist = np.minimum(dist.astype(np.int64), len(table) - 2)
+		dfrac = dist - idist
+		weights = table[idist] * (1 - dfrac) + table[idist + 1] * dfrac
+		gathered = padded[ipos[:, None] + taps[None, :] + ntaps]
+		out[base:base + len(n)] = np.einsum("ij,ij->i", gathered, weights) * cutoff
+	return out
+
+def fade_in(samples, length=None):
+	# sox "fade h": half a cosine
+	if length is None:
+		length = len(samples)
+	env = np.ones(len(samples))
+	env[:length] = (1 - np.cos(np.pi * np.arange(length) / length)) / 2
+	return samples * env
+
+def fade_out(samples, length=None):
+	if length is None:
+		length = len(samples)
+	env = np.ones(len(samples))
+	env[len(samples) - length:] = (1 + np.cos(np.pi * np.arange(length) / length)) / 2
+	return samples * env
+
+def prepare(fn, start, vol, rate, length=None):
+	# trim, downmix, boost and resample a recording, ie the first sox step of doloop/donoloop
+	samples, inrate = read_wav(fn)
+	samples = gain(mix_mono(samples[start:]), vol)
+	return resample(samples, inrate, rate, length)
+
+def loop_buffer(samples, loop, looplen):
+	# everything up to the end of the first loop, followed by the loop again crossfaded with
+	# the copy that follows it, so that the end of it leads cleanly back into its own start
+	# (this second copy is the bit that actually loops)
+	head = samples[:loop + looplen]
+	fadein = fade_in(samples[loop:loop + looplen])
+	fadeout = fade_out(samples[loop + looplen:loop + 2 * looplen])
+	if len(fadein) != looplen or len(fadeout) != looplen:
+		raise ValueError("sample is too short for the loop")
+	return np.concatenate([head, fadein + fadeout])
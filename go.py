@@ -5,12 +5,14 @@ import os
 import subprocess
 import sys
 
-from constants import RATE
+from constants import MAX_BEND, RATE
 from vgm import read_file
+import ym
 from ym import process_ym, render_ym, ym_to_midi
-from psg import process_psg, render_psg, psg_to_midi
+from psg import BASE_CHANNEL, process_psg, render_psg, psg_to_midi
 from extract import extract_channels
 import midifile
+from midicolumns import ColumnarTrack, thin_bends
 
 # seconds per quarter note
 SONGSPEED = [None] * 17
@@ -44,6 +46,13 @@ SONGDELAY[13] = 10
 SONGDELAY[14] = 10
 
 ALLFILES = True
+STEMS = True
+OUTDIR = "out"
+# thin out the pitch bends to within this many cents (--bend-error=CENTS), off by default
+BEND_ERROR = None
+# and no closer together than this many MIDI ticks (--bend-spacing=TICKS), by folding any that
+# are closer into the one before, which means the pitch is no longer always within BEND_ERROR
+BEND_SPACING = 0
 
 def process_songdata(hdr, commands):
 	ym = list(process_ym(hdr, commands))
@@ -74,23 +83,33 @@ def render_midi(hdr, gd3, ym, psg, dn, songnum):
 	if speed is None:
 		print(f"{songnum} - {hdr.loopsample}")
 		speed = 0.5
-	tracks = retime_midi(hdr, tracks, speed, SONGDELAY[songnum])
+	columns = [ColumnarTrack.from_track(track) for track in tracks]
+	retime_midi(hdr, columns, speed, SONGDELAY[songnum])
+	if BEND_ERROR is not None:
+		before = sum(status & 0xF0 == 0xE0 for col in columns for status in col.status)
+		columns, removed = thin_bends(columns, BEND_ERROR, bend_range, BEND_SPACING)
+		print(f"  thinned out {removed:,d} of {before:,d} pitch bends" + (f" (not always within {BEND_ERROR:g} cents, with --bend-spacing)" if BEND_SPACING else ""))
 	# add the timesig _after_ retiming, since we're calculating their position based on the new timescale
-	tracks[0][3:3] = [
+	columns[0].insert(3, [
 		midifile.TimedMidiEvent(ts, midifile.MetaEvent(midifile.Events.TIME_SIG, bytes([num, denom, MIDI_TICKRATE, 8])))
 		for ts, num, denom in get_timesig(songnum)
-	]
-	midi = midifile.MidiFile(midifile.MidiFileType.MULTITRACK, MIDI_TICKRATE, tracks)
+	])
+	midi = midifile.MidiFile(midifile.MidiFileType.MULTITRACK, MIDI_TICKRATE, [col.to_track() for col in columns])
 	#midi.pprint()
 	fn = os.path.join(dn, "output.mid")
 	with open(fn, "wb") as fp:
 		midifile.write_midi_file(fp, midi)
-	for track in tracks:
-		track[:] = [ev._replace(event=ev.event._replace(channel=0)) if hasattr(ev.event, 'channel') else ev for ev in track]
+	for col in columns:
+		col.remap_channels(0)
+	midi = midi._replace(tracks=[col.to_track() for col in columns])
 	fn = os.path.join(dn, "output_noch.mid")
 	with open(fn, "wb") as fp:
 		midifile.write_midi_file(fp, midi)
 
+def bend_range(channel):
+	# what the pitch bend sensitivity gets set to, in semitones
+	return 1 if channel >= BASE_CHANNEL else MAX_BEND
+
 def get_timesig(songnum):
 	ts = 0
 	for i in TIMESIG[songnum]:
@@ -107,30 +126,21 @@ def retime_midi(hdr, tracks, songspeed, delay):
 	samp_per_note = songspeed * RATE
 	samp_per_tick = samp_per_note / MIDI_TICKRATE
 	usec_per_note = round(songspeed * 1e6)
-	def newtime(ev):
-		newtime = round(ev.time / samp_per_tick)
-		if newtime > 0 or not isinstance(ev.event, midifile.MetaEvent):
-			newtime += delay
-		return newtime
-	newtracks = [
-		[
-			midifile.TimedMidiEvent(newtime(ev), ev.event)
-			for ev in track
-		]
-		for track in tracks
-	]
-	newtracks[0].insert(0, midifile.TimedMidiEvent(0, midifile.MetaEvent(midifile.Events.TEMPO, struct.pack(">L", round(usec_per_note))[1:])))
-	return newtracks
+	for col in tracks:
+		col.retime(samp_per_tick, delay)
+	tracks[0].insert(0, [midifile.TimedMidiEvent(0, midifile.MetaEvent(midifile.Events.TEMPO, struct.pack(">L", round(usec_per_note))[1:]))])
+	return tracks
 
 def dofile(fn):
-	dn = os.path.join("out", fn[:-4] if fn.endswith(".vgm") else fn)
-	if not os.path.exists("out"):
-		os.mkdir("out")
+	dn = os.path.join(OUTDIR, fn[:-4] if fn.endswith(".vgm") else fn)
+	if not os.path.exists(OUTDIR):
+		os.mkdir(OUTDIR)
 	if not os.path.exists(dn):
 		os.mkdir(dn)
 	songnum = int(fn[:2])
 	process_file(fn, dn, songnum)
-	extract_channels(fn, dn)
+	if STEMS:
+		extract_channels(fn, dn)
 
 def main():
 	args = sys.argv[1:]
@@ -146,4 +156,14 @@ def main():
 			dofile(i)
 
 if __name__ == "__main__":
+	for arg in sys.argv[1:]:
+		if arg == "--voices":
+			ym.SPLIT_VOICES = True
+			sys.argv.remove(arg)
+		elif arg.startswith("--bend-error="):
+			BEND_ERROR = float(arg.split("=", 1)[1])
+			sys.argv.remove(arg)
+		elif arg.startswith("--bend-spacing="):
+			BEND_SPACING = int(arg.split("=", 1)[1])
+			sys.argv.remove(arg)
 	main()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Regression check for the go.py pipeline: runs everything into a scratch out/
+# tree, hashes the results, and compares them against the checked-in manifest.
+#   ./golden.py [--no-audio]         check against the manifest
+#   ./golden.py update [--no-audio]  rewrite the manifest from a fresh run
+import glob
+import hashlib
+import os
+import shutil
+import sys
+
+import go
+import ym
+import midifile
+
+TOP = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = "golden.sha256"
+SCRATCH = "tmp/golden/out"
+REFERENCE = "out"
+AUDIO_EXTS = (".wav", ".silent")
+
+def run_pipeline(outdir, audio=True):
+	if os.path.exists(outdir):
+		shutil.rmtree(outdir)
+	os.makedirs(outdir)
+	go.OUTDIR = outdir
+	go.STEMS = audio
+	ym.RENDER_WAVS = audio
+	for fn in sorted(glob.glob("[0-9][0-9]*.vgm")):
+		print(fn)
+		go.dofile(fn)
+
+def hash_file(fn):
+	h = hashlib.sha256()
+	with open(fn, "rb") as fp:
+		while True:
+			dat = fp.read(1 << 16)
+			if not dat:
+				break
+			h.update(dat)
+	return h.hexdigest()
+
+def hash_tree(dn):
+	res = {}
+	for root, dirs, files in os.walk(dn):
+		for fn in files:
+			path = os.path.join(root, fn)
+			res[os.path.relpath(path, dn).replace(os.sep, "/")] = hash_file(path)
+	return res
+
+def read_manifest(fn=MANIFEST):
+	res = {}
+	with open(fn) as fp:
+		for line in fp:
+			line = line.rstrip("\n")
+			if line:
+				digest, path = line.split("  ", 1)
+				res[path] = digest
+	return res
+
+def write_manifest(hashes, fn=MANIFEST):
+	with open(fn, "w") as fp:
+		for path, digest in sorted(hashes.items()):
+			print(f"{digest}  {path}", file=fp)
+
+def is_audio(path):
+	return path.endswith(AUDIO_EXTS)
+
+def diff_midi(fn_a, fn_b):
+	# describe the first semantic difference between two MIDI files, or None if they're equivalent
+	with open(fn_a, "rb") as fp:
+		a = midifile.parse_midi_file(fp)
+	with open(fn_b, "rb") as fp:
+		b = midifile.parse_midi_file(fp)
+	if a.type != b.type:
+		return f"file type {a.type.name} != {b.type.name}"
+	if a.rate != b.rate:
+		return f"rate {a.rate} != {b.rate}"
+	for tr, (track_a, track_b) in enumerate(zip(a.tracks, b.tracks)):
+		for ix, (ev_a, ev_b) in enumerate(zip(track_a, track_b)):
+			if ev_a != ev_b:
+				return f"track {tr} event {ix}: expected TimedMidiEvent({ev_a.time}, {ev_a.event}), got TimedMidiEvent({ev_b.time}, {ev_b.event})"
+		if len(track_a) != len(track_b):
+			ix = min(len(track_a), len(track_b))
+			extra = track_a[ix] if len(track_a) > ix else track_b[ix]
+			return f"track {tr} length {len(track_a)} != {len(track_b)}, first unmatched event {ix}: TimedMidiEvent({extra.time}, {extra.event})"
+	if len(a.tracks) != len(b.tracks):
+		return f"track count {len(a.tracks)} != {len(b.tracks)}"
+	return None
+
+def compare(expected, actual, audio=True):
+	failures = 0
+	for path, digest in sorted(expected.items()):
+		if not audio and is_audio(path):
+			continue
+		if path not in actual:
+			print(f"MISSING  {path}")
+			failures += 1
+		elif actual[path] != digest:
+			print(f"CHANGED  {path}")
+			failures += 1
+			ref = os.path.join(REFERENCE, path)
+			if path.endswith(".mid") and os.path.exists(ref) and hash_file(ref) == digest:
+				print(f"  {diff_midi(ref, os.path.join(SCRATCH, path)) or 'events are identical, encoding differs'}")
+	for path in sorted(actual.keys() - expected.keys()):
+		print(f"UNTRACKED  {path}")
+	return failures
+
+def main():
+	os.chdir(TOP)
+	args = sys.argv[1:]
+	audio = "--no-audio" not in args
+	run_pipeline(SCRATCH, audio)
+	actual = hash_tree(SCRATCH)
+	if "update" in args:
+		if audio:
+			write_manifest(actual)
+		else:
+			# keep whatever audio hashes we already had, since we didn't regenerate them
+			old = read_manifest() if os.path.exists(MANIFEST) else {}
+			write_manifest({**{k: v for k, v in old.items() if is_audio(k)}, **actual})
+		print(f"Wrote {MANIFEST}")
+		return
+	failures = compare(read_manifest(), actual, audio)
+	print()
+	if failures:
+		print(f"{failures} artifact(s) differ")
+		sys.exit(1)
+	print("All artifacts match")
+
+if __name__ == "__main__":
+	main()
@@ -1,189 +1,93 @@
 #!/usr/bin/python
-import shlex
-import subprocess
-from math import floor, ceil
-import shutil
-import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
 import os
 import sys
+import tempfile
 
-ORIGRATE = 44100
-VOL = 5
-MAXRATE = 16000
+import brr
+import dsp
+from manifest import read_manifest
 
 SKIPBUILD = False
+QUALITY = False
+JOBS = os.cpu_count()
+# bump this whenever the way samples are built changes, to force everything to rebuild
+BUILD_VERSION = 2
 
-def call(args):
-	print(">", shlex.join(args))
-	if args[0] != "sox":
-		subprocess.check_call(args)
-		return
-	try:
-		res = subprocess.check_output(args, stderr=subprocess.STDOUT).decode("utf-8")
-	except subprocess.CalledProcessError as ex:
-		print(ex.output.decode("utf-8"))
-		raise
-	print(res)
-	if "sox WARN" in res:
-		raise Exception("sox warning")
-
-def doloop(inst, note, rate, start, loop, end, adsr=0xFFE0, insuffix="", suffix="", transpose=None, maxnote=None, vol=VOL):
-	# round rate so that the loop is a whole number of blocks
-	looplen = (end - loop) / ORIGRATE
-	loopsamp = looplen * rate
-	loopblocks = round(loopsamp / 16)
-	rate = (16 * loopblocks) / looplen
-	loopatblocks = ceil((loop - start) / ORIGRATE * rate / 16)
-	newloop = loopatblocks * 16
-	newlooplen = loopblocks * 16
-	looppoint = loopatblocks + loopblocks + 1
-
-	if not os.path.exists(f"inst/ec-fm-{inst:02d}{suffix}.brr") and not SKIPBUILD:
-		call(["sox", f"out/inst{inst:02d}_{note:02d}{insuffix}.wav", "tmp/tmp1.wav", "trim", f"{start}s", "channels", "1", "vol", f"{vol}dB", "rate", f"{rate}"])
-		call(["sox", "tmp/tmp1.wav", "tmp/tmp2.wav", "trim", "0s", f"{newloop+newlooplen}s"])
-		#call(["sox", "tmp/tmp1.wav", "tmp/tmp3.wav", "trim", f"{newloop + newlooplen//4}s", f"{newlooplen*3//4}s"])
-		#call(["sox", "tmp/tmp1.wav", "tmp/tmp4.wav", "trim", f"{newloop + newlooplen}s", f"{newlooplen*3//4}s"])
-		#call(["sox", "tmp/tmp4.wav", "tmp/tmp3.wav", "tmp/tmp5.wav", "splice", f"{newlooplen//2}s,{newlooplen//4}s,0"])
-		call(["sox", "tmp/tmp1.wav", "tmp/tmp3.wav", "trim", f"{newloop}s", f"{newlooplen}s", "fade", "h", f"{newlooplen}s"])
-		call(["sox", "tmp/tmp1.wav", "tmp/tmp4.wav", "trim", f"{newloop + newlooplen}s", f"{newlooplen}s", "fade", "h", "0s", f"{newlooplen}s", f"{newlooplen}s"])
-		call(["sox", "-M", "tmp/tmp3.wav", "tmp/tmp4.wav", "tmp/tmp5.wav", "remix", "1v1,2v1"])
-		call(["sox", "tmp/tmp2.wav", "tmp/tmp5.wav", "tmp/tmp6.wav"])
-		call(["wine", "../smwhack/brrtools/brr_encoder.exe", "-l", "tmp/tmp6.wav", "tmp/tmp.brr"])
-		call(["wine", "../smwhack/brrtools/brr_decoder.exe", f"-s{rate}", f"-l{looppoint}", f"-m2", "tmp/tmp.brr", f"tmp/out_{inst:02d}{suffix}.wav"])
-		with open(f"inst/ec-fm-{inst:02d}{suffix}.brr", "wb") as fpout, open("tmp/tmp.brr", "rb") as fpin:
-			fpout.write(struct.pack("<H", looppoint * 9))
-			shutil.copyfileobj(fpin, fpout)
-		if not os.path.exists(f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/ec-fm-{inst:02d}{suffix}.brr"):
-			os.symlink(f"/home/phlip/eternalchampions/inst/ec-fm-{inst:02d}{suffix}.brr", f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/ec-fm-{inst:02d}{suffix}.brr")
-
-	notefreq = 440 * 2**(((transpose or note)-69)/12)
-	tuning = rate / notefreq / 8
-	tuninga = floor(tuning)
-	tuningb = round((tuning - tuninga) * 256)
+def cache_key(sample, quality=False):
+	# everything that goes into building the sample: its manifest entry, the recording it's cut from, and how it's encoded
+	h = hashlib.sha256()
+	h.update(repr((BUILD_VERSION, quality, sample)).encode("utf-8"))
+	with open(sample.source, "rb") as fp:
+		while True:
+			dat = fp.read(1 << 16)
+			if not dat:
+				break
+			h.update(dat)
+	return h.hexdigest()
 
-	if maxnote is not None:
-		if transpose:
-			maxnote += transpose - note
-		highfreq = 440 * 2**((maxnote - 69)/12) * tuning
-		if highfreq > MAXRATE:
-			raise ValueError(f"Sample rate {rate} for {inst:02d}{suffix} is too high! Reduce to {rate*MAXRATE/highfreq}")
+def key_file(sample):
+	# kept out of inst/, which is checked in, so they never show up in git status
+	return f"tmp/instkeys/{sample.name}.key"
 
-	print(f"\"ec-fm-{inst:02d}{suffix}.brr\" ${adsr>>8:02X} ${adsr&0xFF:02X} $00 ${tuninga:02X} ${tuningb:02X}")
+def is_stale(sample, key):
+	if not os.path.exists(f"inst/{sample.name}") or not os.path.exists(key_file(sample)):
+		return True
+	with open(key_file(sample)) as fp:
+		return fp.read().strip() != key
 
-def donoloop(inst, note, rate, start, end, adsr=0xFFE0, insuffix="", suffix="", transpose=None, maxnote=None, vol=VOL):
-	fulllen = (end - start) / ORIGRATE
-	samp = fulllen * rate
-	blocks = round(samp / 16)
-	rate = (16 * blocks) / fulllen
-	newsamp = blocks * 16
+def build_sample(sample, quality=False, scratch="tmp"):
+	rate, loop, looplen, looppoint = sample.layout()
+	if looppoint is not None:
+		# trim, mix down, boost and resample, then crossfade the loop, all in memory
+		samples = dsp.prepare(sample.source, sample.start, sample.vol, rate, loop + 2*looplen)
+		samples = dsp.to_pcm16(dsp.loop_buffer(samples, loop, looplen), sample.name)
+		data = brr.encode(samples, loop=True, quality=quality)
+	else:
+		samples = dsp.prepare(sample.source, sample.start, sample.vol, rate, loop)
+		data = brr.encode(dsp.to_pcm16(samples, sample.name), quality=quality)
+	# decode it again, so there's something to listen to to check the loop
+	dsp.write_wav(f"tmp/out_{sample.inst:02d}{sample.suffix}.wav", brr.decode(data, looppoint, 2) / 32768, rate)
+	# build in our own scratch directory and move into place, so a half-written sample never ends up in inst/
+	brr.write_brr(os.path.join(scratch, sample.name), data, looppoint)
+	os.replace(os.path.join(scratch, sample.name), f"inst/{sample.name}")
+	if not os.path.exists(f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/{sample.name}"):
+		os.symlink(f"/home/phlip/eternalchampions/inst/{sample.name}", f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/{sample.name}")
 
-	if not os.path.exists(f"inst/ec-fm-{inst:02d}{suffix}.brr") and not SKIPBUILD:
-		call(["sox", f"out/inst{inst:02d}_{note:02d}{insuffix}.wav", "tmp/tmp1.wav", "trim", f"{start}s", "channels", "1", "vol", f"{vol}dB", "rate", f"{rate}"])
-		call(["sox", "tmp/tmp1.wav", "tmp/tmp2.wav", "trim", "0s", f"{newsamp}s"])
-		call(["wine", "../smwhack/brrtools/brr_encoder.exe", "tmp/tmp2.wav", "tmp/tmp.brr"])
-		call(["wine", "../smwhack/brrtools/brr_decoder.exe", f"-s{rate}", "tmp/tmp.brr", f"tmp/out_{inst:02d}{suffix}.wav"])
-		with open(f"inst/ec-fm-{inst:02d}{suffix}.brr", "wb") as fpout, open("tmp/tmp.brr", "rb") as fpin:
-			fpout.write(struct.pack("<H", 0))
-			shutil.copyfileobj(fpin, fpout)
-		if not os.path.exists(f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/ec-fm-{inst:02d}{suffix}.brr"):
-			os.symlink(f"/home/phlip/eternalchampions/inst/ec-fm-{inst:02d}{suffix}.brr", f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/ec-fm-{inst:02d}{suffix}.brr")
-
-	notefreq = 440 * 2**(((transpose or note)-69)/12)
-	tuning = rate / notefreq / 8
-	tuninga = floor(tuning)
-	tuningb = round((tuning - tuninga) * 256)
-
-	if maxnote is not None:
-		if transpose:
-			maxnote += transpose - note
-		highfreq = 440 * 2**((maxnote - 69)/12) * tuning
-		if highfreq > MAXRATE:
-			raise ValueError(f"Sample rate {rate} for {inst:02d}{suffix} is too high! Reduce to {rate*MAXRATE/highfreq}")
-
-	print(f"\"ec-fm-{inst:02d}{suffix}.brr\" ${adsr>>8:02X} ${adsr&0xFF:02X} $00 ${tuninga:02X} ${tuningb:02X}")
+def run_job(sample, build=True, quality=False):
+	if build:
+		key = cache_key(sample, quality)
+		if is_stale(sample, key):
+			with tempfile.TemporaryDirectory(dir="tmp") as scratch:
+				build_sample(sample, quality, scratch)
+			with open(key_file(sample), "w") as fp:
+				print(key, file=fp)
+	return sample.tuning()
 
 def main():
-	donoloop(0, 36, 16384, 0, 7368, transpose=60)
-	doloop(1, 43, 8192, 0, 26126, 29736, maxnote=52)
-	doloop(2, 45, 16384, 0, 23269, 24872, maxnote=80)
-	# duplicate of the instrument at a lower bitrate to use for higher notes
-	doloop(2, 45, 9216, 0, 23269, 24872, maxnote=89, transpose=33, suffix="-8va")
-	# No instruments 3 or 4 - are essentially the same as instrument 2
-	donoloop(5, 38, 16384, 0, 10252, transpose=60)
-	doloop(6, 45, 4096, 0, 36856, 43272, maxnote=73)
-	doloop(7, 80, 8192, 0, 8822, 9775, 0xCFF1, maxnote=106)
-	donoloop(8, 36, 8192, 0, 12000, transpose=60)
-	donoloop(9, 53, 8192, 0, 5400, transpose=60)
-	doloop(10, 71, 6144, 0, 11355, 12070, 0xCFF1, maxnote=75)
-	doloop(11, 78, 8192, 0, 25796, 26749, 0xAFED, maxnote=87)
-	doloop(12, 48, 8192, 0, 43819, 49218)
-	doloop(13, 70, 16384, 0, 14276, 15036)
-	doloop(14, 70, 16384, 0, 3027, 3406, 0xFFF0)
-	donoloop(15, 58, 16384, 0, 4500, transpose=60)
-	doloop(16, 69, 16384, 72369, 72369, 73170, 0xC9C0)
-	doloop(17, 67, 16384, 0, 1124, 2024)
-	doloop(18, 64, 16384, 0, 3278, 4349, 0xFFEE)
-	doloop(19, 36, 4096, 0, 6744, 17520)
-	doloop(20, 57, 16384, 0, 7715, 8518, 0xFFEE)
-	donoloop(21, 38, 16384, 0, 7150, transpose=60)
-	doloop(22, 44, 6144, 0, 27658, 34058, maxnote=51)
-	donoloop(23, 36, 8192, 0, 14856, transpose=60)
-	# No instrument 24, is essentially the same as 25
-	doloop(25, 68, 16384, 0, 13358, 14207, maxnote=93)
-	doloop(26, 72, 16384, 0, 1769, 2442, 0xFFEB, maxnote=86)
-	donoloop(27, 61, 16384, 0, 6250, transpose=60)
-	doloop(28, 71, 16384, 0, 10000, 10714, 0xFFEB, maxnote=82)
-	donoloop(29, 70, 16384, 0, 5356, maxnote=74)
-	doloop(30, 70, 16384, 0, 21840, 22596, 0xFFEE, maxnote=82)
-	doloop(31, 51, 15000, 0, 17885, 20151, maxnote=88)
-	# instrument 31 in parallel fifths, for Blade's Stage and Jetta's Stage
-	doloop(31, 40, 8192, 0, 18338, 26901, insuffix="+47", suffix="-fifths", maxnote=43, vol=-1, transpose=52)
-	doloop(32, 63, 8192, 0, 29866, 30998, maxnote=67)
-	doloop(33, 76, 8192, 54626, 54626, 54893, maxnote=83)
-	doloop(34, 79, 16384, 0, 5735, 6635, 0xFFEE, maxnote=83)
-	doloop(35, 64, 16384, 0, 11502, 12572, maxnote=77)
-	doloop(36, 60, 8192, 0, 6737, 9432, maxnote=71)
-	doloop(37, 61, 16384, 8277, 8277, 9550, 0xBFA0, maxnote=77)
-	doloop(38, 77, 16384, 7198, 7198, 7703, 0xF9E0, maxnote=89)
-	doloop(39, 81, 8192, 1352, 1352, 1552, 0xFBE0, maxnote=91)
-	# instrument 40 is the same sample as 38
-	doloop(41, 59, 16384, 104292, 104292, 107150, 0xF1EC, maxnote=59)
-	doloop(42, 56, 16384, 22916, 22916, 26318, 0x8460, maxnote=83)
-	doloop(43, 39, 8192, 0, 36937, 41486, 0x9FEF, maxnote=39)
-	doloop(44, 85, 16384, 0, 6648, 6807, 0xCFF4, maxnote=90)
-	donoloop(45, 37, 8192, 0, 11736, transpose=60)
-	donoloop(46, 75, 16384, 0, 4739, transpose=60)
-	doloop(47, 80, 16384, 0, 8447, 8659, 0xCFF4, maxnote=87)
-	doloop(48, 45, 8192, 0, 32662, 35866, maxnote=51)
-	doloop(49, 45, 6144, 0, 34453, 37662, maxnote=54)
-	doloop(50, 79, 8192, 3486, 3486, 3542, maxnote=90)
-	donoloop(51, 64, 8192, 0, 6967, maxnote=78)
-	donoloop(52, 66, 16384, 0, 5581, maxnote=67)
-	donoloop(53, 60, 16384, 0, 3543, transpose=60)
-	donoloop(54, 66, 16384, 0, 7981, maxnote=79)
-	doloop(55, 59, 16384, 0, 4911, 5625, 0xAFC0, maxnote=74)
-	doloop(31, 59, 16384, 0, 23466, 24179, insuffix="_inst55+square", suffix="-55-square", vol=0, maxnote=82)
-	doloop(56, 53, 16384, 0, 21479, 22490, maxnote=83)
-	doloop(57, 44, 8192, 0, 19538, 22936, 0xAFED, maxnote=54)
-	doloop(58, 76, 16384, 0, 14058, 14593, maxnote=88)
-	# 59 is the same sample as 56
-	doloop(7, 80, 8192, 0, 8822, 9775, 0xCFF1, insuffix="_square", suffix="-square", maxnote=89)
-	donoloop(60, 36, 8192, 0, 17702, transpose=60)
-	doloop(61, 64, 8192, 0, 20340, 22481, maxnote=75)
-	# 62 is the same sample as 67
-	doloop(63, 72, 16384, 0, 2109, 2783, 0xFFED, maxnote=81)
-	doloop(64, 76, 8192, 0, 9960, 10027, maxnote=86)
-	donoloop(65, 59, 16384, 0, 10226, transpose=60)
-	doloop(66, 48, 8192, 0, 1351, 2026, 0xFFF3, transpose=60)
-	doloop(67, 72, 16384, 0, 4424, 4761, maxnote=82)
-	doloop(68, 56, 8192, 0, 50085, 53480, 0x8FF0, maxnote=62)
-	donoloop(69, 58, 16384, 0, 5795, transpose=60)
-	donoloop(69, 58, 16384, 0, 17702, transpose=60, insuffix="_inst60", suffix="-60")
-	donoloop(69, 58, 16384, 0, 8568, transpose=60, insuffix="_inst70", suffix="-70")
-	donoloop(70, 64, 16384, 0, 8568, transpose=60)
-	doloop(71, 63, 8192, 0, 30862, 31995, maxnote=68)
+	os.makedirs("tmp/instkeys", exist_ok=True)
+	samples = read_manifest()
+	run = partial(run_job, build=not SKIPBUILD, quality=QUALITY)
+	if SKIPBUILD or JOBS == 1:
+		for line in map(run, samples):
+			print(line)
+		return
+	with ProcessPoolExecutor(JOBS) as pool:
+		# map hands results back in the original order, whatever order they finish in
+		for line in pool.map(run, samples):
+			print(line)
 
 if __name__ == "__main__":
 	if "--skip" in sys.argv:
 		SKIPBUILD = True
+	if "--quality" in sys.argv:
+		QUALITY = True
+	for arg in sys.argv[1:]:
+		if arg.startswith("-j"):
+			# a bare -j is one job per core, same as leaving it out
+			if arg != "-j" and not (arg[2:].isdigit() and int(arg[2:]) >= 1):
+				sys.exit(f"Expected -j or -jN with N at least 1, not {arg}")
+			JOBS = int(arg[2:] or os.cpu_count())
 	main()
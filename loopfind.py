@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# Suggest loop points for an instrument recording, rather than hunting for them in Audacity.
+#   ./loopfind.py INST NOTE RATE [FROM [TO]] [insuffix=...]
+# prints candidate samples.txt lines, smallest BRR first
+import sys
+
+import numpy as np
+
+import dsp
+from manifest import Sample, ORIGRATE
+
+NOTELEN = ORIGRATE * 3  # gen_instrument_wav holds the note for 3 seconds
+MIN_LOOP = ORIGRATE // 400
+MAX_LOOP = ORIGRATE
+CANDIDATE_LAGS = 32
+SUSTAIN_DB = 1.0
+SUSTAIN_SPAN = ORIGRATE // 2
+SILENCE_DB = 40
+MAX_RATE_CHANGE = 0.05  # how far the block rounding may move the rate for a given loop length
+MAX_ERROR = 0.02  # crossfade mismatch, as a fraction of the energy of the two halves
+
+def load(fn):
+	samples, rate = dsp.read_wav(fn)
+	assert rate == ORIGRATE
+	return dsp.mix_mono(samples)
+
+def sustain_region(x, tolerance=SUSTAIN_DB):
+	# where to look for a loop: from the first point after the attack where the level holds steady
+	# for a while, so the loop doesn't freeze the instrument part way through its decay, up to the
+	# note-off or wherever it has died away
+	# windows long enough to average out any tremolo
+	win = ORIGRATE // 20
+	nwin = NOTELEN // win
+	rms = np.sqrt(np.mean(x[:nwin * win].reshape(nwin, win) ** 2, axis=1))
+	db = 20 * np.log10(np.maximum(rms, 1e-9))
+	peak = int(np.argmax(db))
+	quiet = np.nonzero(db[peak:] < db[peak] - SILENCE_DB)[0]
+	end = peak + int(quiet[0]) if len(quiet) else nwin
+	span = SUSTAIN_SPAN // win
+	for i in range(peak, end - span):
+		if np.all(np.abs(db[i:i + span] - db[i]) <= tolerance):
+			return i * win, end * win
+	# instruments that decay all the way (the ones with an ADSR envelope) just get anything after the attack
+	return peak * win, end * win
+
+def candidate_lags(x, min_len, max_len, count=CANDIDATE_LAGS):
+	# autocorrelation by FFT, normalised for the shrinking overlap, then the strongest local peaks
+	n = len(x)
+	spec = np.fft.rfft(x, 2 * n)
+	acf = np.fft.irfft(spec * np.conj(spec))[:n]
+	if acf[0] <= 0:
+		return []
+	acf = acf / acf[0] * n / (n - np.arange(n))
+	max_len = min(max_len, n // 2)
+	lags = np.arange(min_len, max_len)
+	vals = acf[min_len:max_len]
+	peaks = (vals[1:-1] > vals[:-2]) & (vals[1:-1] >= vals[2:])
+	lags = lags[1:-1][peaks]
+	vals = vals[1:-1][peaks]
+	order = np.argsort(-vals)[:count]
+	return [int(i) for i in lags[order]]
+
+def window_errors(x, looplen):
+	# for every possible loop start p, how badly x[p:p+looplen] matches the copy of it that follows,
+	# which is what gets crossfaded together when the loop is built
+	a = x[:-looplen]
+	b = x[looplen:]
+	diff = np.concatenate([[0], np.cumsum((a - b) ** 2)])
+	energy = np.concatenate([[0], np.cumsum(a ** 2 + b ** 2)])
+	nstarts = len(x) - 2 * looplen + 1
+	if nstarts <= 0:
+		return np.zeros(0)
+	num = diff[looplen:looplen + nstarts] - diff[:nstarts]
+	den = energy[looplen:looplen + nstarts] - energy[:nstarts]
+	return num / np.maximum(den, 1e-12)
+
+def find_loops(inst, note, rate, start=0, frm=None, to=None, insuffix="", max_error=MAX_ERROR, min_len=MIN_LOOP, max_len=MAX_LOOP):
+	x = load(Sample(inst, note, rate, start, None, start, insuffix=insuffix).source)
+	if frm is None or to is None:
+		autofrm, autoto = sustain_region(x)
+		if frm is None:
+			frm = max(start, autofrm)
+		if to is None:
+			to = autoto
+	region = x[frm:to]
+	res = []
+	for looplen in candidate_lags(region, min_len, max_len):
+		errs = window_errors(x[start:to], looplen)
+		if not len(errs):
+			continue
+		# loop starts we could ask for, and where the block rounding actually puts them
+		loops = np.arange(frm, start + len(errs))
+		sample = Sample(inst, note, rate, start, frm, frm + looplen, insuffix=insuffix)
+		newrate = sample.layout()[0]
+		if abs(newrate / rate - 1) > MAX_RATE_CHANGE:
+			continue
+		loopatblocks = np.ceil((loops - start) / ORIGRATE * newrate / 16).astype(np.int64)
+		actual = start + np.round(loopatblocks * 16 * ORIGRATE / newrate).astype(np.int64)
+		valid = actual - start < len(errs)
+		if not valid.any():
+			continue
+		loops, actual = loops[valid], actual[valid]
+		err = errs[actual - start]
+		good = np.nonzero(err <= max_error)[0]
+		# earliest acceptable loop is the smallest sample; otherwise just take the best match
+		ix = good[0] if len(good) else int(np.argmin(err))
+		loop = int(loops[ix])
+		sample = Sample(inst, note, rate, start, loop, loop + looplen, insuffix=insuffix)
+		newrate, newloop, newlooplen, looppoint = sample.layout()
+		size = 2 + 9 * (looppoint + newlooplen // 16)
+		res.append((float(err[ix]) > max_error, size, float(err[ix]), sample, newrate))
+	res.sort(key=lambda i: i[:3])
+	return [(sample, size, err, newrate) for _, size, err, sample, newrate in res]
+
+def format_line(sample):
+	line = f"loop {sample.inst} {sample.note} {sample.rate} {sample.start} {sample.loop} {sample.end}"
+	if sample.insuffix:
+		line += f" insuffix={sample.insuffix}"
+	return line
+
+def main():
+	args = [i for i in sys.argv[1:] if "=" not in i]
+	opts = dict(i.split("=", 1) for i in sys.argv[1:] if "=" in i)
+	inst, note, rate = map(int, args[:3])
+	frm = int(args[3]) if len(args) > 3 else None
+	to = int(args[4]) if len(args) > 4 else None
+	for sample, size, err, newrate in find_loops(inst, note, rate, frm=frm, to=to, insuffix=opts.get("insuffix", "")):
+		print(f"{format_line(sample):48s} # {size:6,d} bytes, mismatch {err:.4f}, rate {newrate:.1f}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,168 @@
+import hashlib
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# Loudness measurement as per ITU-R BS.1770 / EBU R128 (K-weighted, gated), standing in for
+# running wavegain over every file.
+# The K-weighting filters are two biquads; rather than run them sample by sample, we run them
+# once over an impulse to get their (very quickly decaying) impulse response, and then apply
+# that as an FIR filter with FFT convolution, a block at a time.
+
+CACHE = "tmp/loudness"
+# bump this whenever the measurement changes, so nothing stale gets picked out of the cache
+VERSION = 1
+# ReplayGain 2's reference level, which is defined to match ReplayGain 1's 89dB (what wavegain
+# uses), so volumes come out on roughly the same scale as before; but only roughly, since the
+# weighting and gating aren't the same, so levels fitted with wavegain don't carry over exactly
+# (see audiolevel.py --calibrate)
+REFERENCE_LUFS = -18.0
+
+IMPULSE_SECONDS = 0.15  # long enough for the K-weighting response to decay to nothing
+BLOCK_SECONDS = 0.4
+STEPS_PER_BLOCK = 4  # ie the blocks overlap by 75%
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+CHUNK_STEPS = 32  # how many 100ms steps to filter at once
+
+def _biquad_impulse(b, a, x):
+	y = np.zeros_like(x)
+	x1 = x2 = y1 = y2 = 0.0
+	for i, x0 in enumerate(x):
+		y0 = b[0] * x0 + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+		y[i] = y0
+		x2, x1 = x1, x0
+		y2, y1 = y1, y0
+	return y
+
+_kernel_cache = {}
+def k_weighting(rate):
+	# the impulse response of the BS.1770 pre-filter (a high shelf) and RLB filter (a high-pass),
+	# designed for this sample rate
+	if rate not in _kernel_cache:
+		f0 = 1681.974450955533
+		gain = 3.999843853973347
+		q = 0.7071752369554196
+		k = np.tan(np.pi * f0 / rate)
+		vh = 10 ** (gain / 20)
+		vb = vh ** 0.4996667741545416
+		a0 = 1 + k / q + k * k
+		shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+		shelf_a = [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+		f0 = 38.13547087602444
+		q = 0.5003270373238773
+		k = np.tan(np.pi * f0 / rate)
+		a0 = 1 + k / q + k * k
+		highpass_b = [1, -2, 1]
+		highpass_a = [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+		impulse = np.zeros(round(IMPULSE_SECONDS * rate))
+		impulse[0] = 1
+		_kernel_cache[rate] = _biquad_impulse(highpass_b, highpass_a, _biquad_impulse(shelf_b, shelf_a, impulse))
+	return _kernel_cache[rate]
+
+def _wav_data(buf):
+	# format and sample data of a wav file, as a view into the (mmapped) file
+	riff, _, wave = struct.unpack_from("<4sL4s", buf, 0)
+	if riff != b"RIFF" or wave != b"WAVE":
+		raise ValueError("not a wav file")
+	pos = 12
+	fmt = None
+	while pos + 8 <= len(buf):
+		chunk, size = struct.unpack_from("<4sL", buf, pos)
+		pos += 8
+		if chunk == b"fmt ":
+			fmt = struct.unpack_from("<HHLLHH", buf, pos)
+		elif chunk == b"data":
+			if fmt is None:
+				raise ValueError("data before fmt chunk")
+			tag, nchannels, rate, _, _, bits = fmt
+			if tag != 1 or bits != 16:
+				raise ValueError("only 16-bit PCM wav files are supported")
+			# things streaming out a wav (like mpv) don't always fill in the real size
+			size = min(size, len(buf) - pos)
+			size -= size % (2 * nchannels)
+			return np.frombuffer(buf, dtype="<i2", count=size // 2, offset=pos).reshape(-1, nchannels), rate
+		pos += size + (size & 1)
+	raise ValueError("no data chunk")
+
+def step_powers(samples, rate):
+	# mean square of the K-weighted signal over each 100ms step, per channel
+	kernel = k_weighting(rate)
+	step = round(rate * BLOCK_SECONDS / STEPS_PER_BLOCK)
+	chunk = step * CHUNK_STEPS
+	nfft = 1 << (chunk + len(kernel) - 1).bit_length()
+	kernel_fft = np.fft.rfft(kernel, nfft)
+	nsteps = len(samples) // step
+	res = np.empty((nsteps, samples.shape[1]))
+	tail = np.zeros((len(kernel) - 1, samples.shape[1]))
+	for base in range(0, nsteps * step, chunk):
+		block = samples[base:min(base + chunk, nsteps * step)] / 32768
+		filtered = np.fft.irfft(np.fft.rfft(block, nfft, axis=0) * kernel_fft[:, None], nfft, axis=0)
+		filtered = filtered[:len(block) + len(kernel) - 1]
+		# overlap-add the ringing from the previous chunk
+		filtered[:len(tail)] += tail
+		tail = filtered[len(block):].copy()
+		filtered = filtered[:len(block)]
+		res[base // step:base // step + len(block) // step] = (filtered ** 2).reshape(-1, step, samples.shape[1]).mean(axis=1)
+	return res
+
+def block_powers(samples, rate):
+	# 400ms blocks, each the average of 4 consecutive steps, all channels weighted equally
+	powers = step_powers(samples, rate)
+	if len(powers) < STEPS_PER_BLOCK:
+		return np.zeros(0)
+	cumulative = np.concatenate([[0], np.cumsum(powers.sum(axis=1))])
+	return (cumulative[STEPS_PER_BLOCK:] - cumulative[:-STEPS_PER_BLOCK]) / STEPS_PER_BLOCK
+
+def integrated_loudness(samples, rate):
+	return gated_loudness(block_powers(samples, rate))
+
+def gated_loudness(blocks):
+	if not len(blocks):
+		return float("-inf")
+	with np.errstate(divide="ignore"):
+		loudness = -0.691 + 10 * np.log10(blocks)
+	gated = blocks[loudness > ABSOLUTE_GATE]
+	if not len(gated):
+		return float("-inf")
+	threshold = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+	gated = blocks[(loudness > ABSOLUTE_GATE) & (loudness > threshold)]
+	return float(-0.691 + 10 * np.log10(gated.mean()))
+
+def measure_file(fn):
+	# integrated loudness of a wav file in LUFS, cached by the file's contents
+	with open(fn, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+		key = hashlib.sha256(buf).hexdigest()
+		cachefn = os.path.join(CACHE, f"{key}.{VERSION}")
+		if os.path.exists(cachefn):
+			with open(cachefn) as cfp:
+				return float(cfp.read())
+		samples, rate = _wav_data(buf)
+		res = integrated_loudness(samples, rate)
+		del samples
+	os.makedirs(CACHE, exist_ok=True)
+	with open(cachefn, "w") as cfp:
+		print(repr(res), file=cfp)
+	return res
+
+def album_loudness(fns):
+	# the loudness of all the files together, as if they were one, the way R128 does albums (so
+	# quiet songs don't count for as much as they would averaging each song's own loudness)
+	blocks = []
+	for fn in fns:
+		with open(fn, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			samples, rate = _wav_data(buf)
+			blocks.append(block_powers(samples, rate))
+			del samples
+	return gated_loudness(np.concatenate(blocks) if blocks else np.zeros(0))
+
+def to_vol(lufs):
+	# as a linear scale, relative to the reference level, ie higher = louder
+	return 10 ** ((lufs - REFERENCE_LUFS) / 20)
+
+def measure_vol(fn):
+	return to_vol(measure_file(fn))
@@ -0,0 +1,122 @@
+from dataclasses import dataclass, replace
+from math import floor, ceil
+from typing import Optional
+
+# The list of instrument samples inst.py builds, read from samples.txt.
+# Kept free of the heavy DSP imports, so build.py can check tuning values without them.
+
+MANIFEST = "samples.txt"
+ORIGRATE = 44100
+VOL = 5
+MAXRATE = 16000
+
+@dataclass(frozen=True)
+class Sample:
+	inst: int
+	note: int
+	rate: int
+	start: int
+	loop: Optional[int]  # None for samples that don't loop
+	end: int
+	adsr: int = 0xFFE0
+	insuffix: str = ""
+	suffix: str = ""
+	transpose: Optional[int] = None
+	maxnote: Optional[int] = None
+	vol: int = VOL
+
+	@property
+	def name(self):
+		return f"ec-fm-{self.inst:02d}{self.suffix}.brr"
+
+	@property
+	def source(self):
+		return f"out/inst{self.inst:02d}_{self.note:02d}{self.insuffix}.wav"
+
+	def layout(self):
+		# round rate so that the loop (or the whole sample) is a whole number of blocks
+		# returns the new rate, the loop start and length in samples at that rate, and the
+		# block the loop starts at in the final BRR (which has an extra block of silence at the start)
+		if self.loop is None:
+			fulllen = (self.end - self.start) / ORIGRATE
+			samp = fulllen * self.rate
+			blocks = round(samp / 16)
+			rate = (16 * blocks) / fulllen
+			return rate, blocks * 16, 0, None
+		looplen = (self.end - self.loop) / ORIGRATE
+		loopsamp = looplen * self.rate
+		loopblocks = round(loopsamp / 16)
+		rate = (16 * loopblocks) / looplen
+		loopatblocks = ceil((self.loop - self.start) / ORIGRATE * rate / 16)
+		return rate, loopatblocks * 16, loopblocks * 16, loopatblocks + loopblocks + 1
+
+	def brr_size(self, rate=None):
+		# bytes the built sample takes up, including the loop header
+		sample = self if rate is None else replace(self, rate=rate)
+		_, loop, looplen, looppoint = sample.layout()
+		if looppoint is None:
+			return 2 + 9 * (1 + loop // 16)
+		return 2 + 9 * (looppoint + looplen // 16)
+
+	def max_rate(self, maxnote=None):
+		# the highest sample rate that still lets maxnote play without going over MAXRATE
+		if maxnote is None:
+			maxnote = self.maxnote
+		if maxnote is None:
+			return None
+		notefreq = 440 * 2**(((self.transpose or self.note)-69)/12)
+		if self.transpose:
+			maxnote += self.transpose - self.note
+		return MAXRATE * notefreq * 8 / (440 * 2**((maxnote - 69)/12))
+
+	def tuning(self):
+		# the line for the #instruments block in the song files
+		rate = self.layout()[0]
+		notefreq = 440 * 2**(((self.transpose or self.note)-69)/12)
+		tuning = rate / notefreq / 8
+		tuninga = floor(tuning)
+		tuningb = round((tuning - tuninga) * 256)
+
+		limit = self.max_rate()
+		if limit is not None and rate > limit:
+			raise ValueError(f"Sample rate {rate} for {self.inst:02d}{self.suffix} is too high! Reduce to {limit}")
+
+		return f"\"{self.name}\" ${self.adsr>>8:02X} ${self.adsr&0xFF:02X} $00 ${tuninga:02X} ${tuningb:02X}"
+
+OPTIONS = {
+	"adsr": lambda v: int(v, 16),
+	"insuffix": str,
+	"suffix": str,
+	"transpose": int,
+	"maxnote": int,
+	"vol": int,
+}
+
+def parse_line(line):
+	kind, *args = line.split()
+	positional = [i for i in args if "=" not in i]
+	options = dict(i.split("=", 1) for i in args if "=" in i)
+	if kind == "loop":
+		inst, note, rate, start, loop, end = map(int, positional)
+	elif kind == "noloop":
+		inst, note, rate, start, end = map(int, positional)
+		loop = None
+	else:
+		raise ValueError(f"Unknown sample type {kind!r}")
+	for key in options:
+		if key not in OPTIONS:
+			raise ValueError(f"Unknown option {key!r}")
+	return Sample(inst, note, rate, start, loop, end, **{key: OPTIONS[key](val) for key, val in options.items()})
+
+def read_manifest(fn=MANIFEST):
+	res = []
+	with open(fn) as fp:
+		for lineno, line in enumerate(fp, 1):
+			line = line.split("#", 1)[0].strip()
+			if not line:
+				continue
+			try:
+				res.append(parse_line(line))
+			except ValueError as ex:
+				raise ValueError(f"{fn} line {lineno}: {ex}") from ex
+	return res
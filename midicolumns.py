@@ -0,0 +1,192 @@
+from array import array
+import heapq
+from itertools import compress, repeat
+from typing import Callable, Iterable, Optional
+
+from midifile import MidiTrack, TimedMidiEvent, SysEx, MetaEvent, decode_midi_event, encode_midi_event
+
+# A MIDI track stored as parallel columns rather than a list of TimedMidiEvent tuples,
+# so whole-track transforms (retiming, channel changes, filtering) don't have to
+# rebuild every event object.
+#   status: the MIDI status byte for channel events, 0xFF for meta events, 0xF0 for sysex
+#   data1: first parameter for channel events, the meta event type, or the sysex device id
+#   data2: second parameter for channel events (-1 if the event only has one), or the sysex terminal flag
+#   payload: the data bytes for meta and sysex events, None otherwise
+
+STATUS_META = 0xFF
+STATUS_SYSEX = 0xF0
+
+class ColumnarTrack:
+	def __init__(self, time: Optional[array] = None, status: Optional[array] = None, data1: Optional[array] = None, data2: Optional[array] = None, payload: Optional[list[Optional[bytes]]] = None):
+		self.time = time if time is not None else array("q")
+		self.status = status if status is not None else array("B")
+		self.data1 = data1 if data1 is not None else array("B")
+		self.data2 = data2 if data2 is not None else array("h")
+		self.payload = payload if payload is not None else []
+
+	@classmethod
+	def from_track(cls, track: Iterable[TimedMidiEvent]) -> "ColumnarTrack":
+		res = cls()
+		time = res.time.append
+		status = res.status.append
+		data1 = res.data1.append
+		data2 = res.data2.append
+		payload = res.payload.append
+		for ev in track:
+			time(ev.time)
+			event = ev.event
+			if isinstance(event, MetaEvent):
+				status(STATUS_META)
+				data1(event.event)
+				data2(-1)
+				payload(event.data)
+			elif isinstance(event, SysEx):
+				status(STATUS_SYSEX)
+				data1(event.device_id)
+				data2(1 if event.terminal else 0)
+				payload(event.message)
+			else:
+				code, p1, p2 = encode_midi_event(event)
+				status(code)
+				data1(p1)
+				data2(-1 if p2 is None else p2)
+				payload(None)
+		return res
+
+	def to_track(self) -> MidiTrack:
+		res = []
+		for time, status, p1, p2, payload in zip(self.time, self.status, self.data1, self.data2, self.payload):
+			if status == STATUS_META:
+				event = MetaEvent(p1, payload)
+			elif status == STATUS_SYSEX:
+				event = SysEx(p1, payload, bool(p2))
+			else:
+				event = decode_midi_event(status, p1, None if p2 < 0 else p2)
+			res.append(TimedMidiEvent(time, event))
+		return res
+
+	def __len__(self) -> int:
+		return len(self.time)
+
+	def copy(self) -> "ColumnarTrack":
+		return ColumnarTrack(array("q", self.time), array("B", self.status), array("B", self.data1), array("h", self.data2), list(self.payload))
+
+	def insert(self, ix: int, track: Iterable[TimedMidiEvent]) -> None:
+		other = track if isinstance(track, ColumnarTrack) else ColumnarTrack.from_track(track)
+		self.time[ix:ix] = other.time
+		self.status[ix:ix] = other.status
+		self.data1[ix:ix] = other.data1
+		self.data2[ix:ix] = other.data2
+		self.payload[ix:ix] = other.payload
+
+	def retime(self, tick_len: float, delay: int = 0) -> None:
+		# convert times to ticks of the given length and shift by delay
+		# meta events that land on 0 stay there, so track names etc are still at the start
+		self.time = array("q", [
+			t + delay if t > 0 or status != STATUS_META else t
+			for t, status in zip((round(t / tick_len) for t in self.time), self.status)
+		])
+
+	def remap_channels(self, mapping: int | dict[int, int] | Callable[[int], int]) -> None:
+		# mapping can be a single channel to put everything on, a dict (unmapped channels are untouched), or a function
+		if isinstance(mapping, int):
+			func = lambda ch: mapping
+		elif isinstance(mapping, dict):
+			func = lambda ch: mapping.get(ch, ch)
+		else:
+			func = mapping
+		# build a translation of every possible status byte, so the whole column is done in one pass
+		table = bytes(
+			status & 0xF0 | func(status & 0x0F) if 0x80 <= status < 0xF0 else status
+			for status in range(256)
+		)
+		self.status = array("B", self.status.tobytes().translate(table))
+
+	def filter(self, keep: Iterable[bool]) -> "ColumnarTrack":
+		keep = list(keep)
+		return ColumnarTrack(
+			array("q", compress(self.time, keep)),
+			array("B", compress(self.status, keep)),
+			array("B", compress(self.data1, keep)),
+			array("h", compress(self.data2, keep)),
+			list(compress(self.payload, keep)),
+		)
+
+	def channel_mask(self, channels: Iterable[int]) -> list[bool]:
+		# which events are channel events on any of the given channels
+		channels = set(channels)
+		return [0x80 <= status < 0xF0 and status & 0x0F in channels for status in self.status]
+
+	@classmethod
+	def merge(cls, tracks: Iterable["ColumnarTrack"]) -> "ColumnarTrack":
+		# tracks must each already be in time order; ties keep the order of the input tracks
+		tracks = list(tracks)
+		order = heapq.merge(*(zip(track.time, repeat(tr), range(len(track))) for tr, track in enumerate(tracks)))
+		res = cls()
+		for time, tr, ix in order:
+			track = tracks[tr]
+			res.time.append(time)
+			res.status.append(track.status[ix])
+			res.data1.append(track.data1[ix])
+			res.data2.append(track.data2[ix])
+			res.payload.append(track.payload[ix])
+		return res
+
+def thin_bends(tracks: list[ColumnarTrack], max_error: float, bend_range: Callable[[int], int], min_spacing: int = 0) -> tuple[list[ColumnarTrack], int]:
+	# drop the pitch bends that don't move the pitch more than max_error cents from where the
+	# previous one left it, and returns the thinned tracks along with how many bends went
+	# each kept bend is set to a value that's within max_error of every one it stands in for, so
+	# a slow slide comes out as steps of up to twice max_error
+	# bend_range gives the pitch bend sensitivity of each channel, in semitones
+	# a bend less than min_spacing ticks after the last one kept gets folded into it instead, so
+	# that one ends up where this one does (except when it comes with a note on, which would
+	# otherwise end up bending the note before it), however far apart they are: so with a
+	# min_spacing, max_error no longer holds, and the pitch can be anything up to min_spacing
+	# ticks early or late (with none, bends that fit within max_error are already dropped, so
+	# folding only those would never drop anything more)
+	# a channel's bends are taken across all the tracks together, but a bend is never stood in
+	# for by one on another track, so each track still works on its own
+	res = [track.copy() for track in tracks]
+	keep = [[True] * len(track) for track in res]
+	note_ons = set()
+	for tr, track in enumerate(res):
+		for time, status, p2 in zip(track.time, track.status, track.data2):
+			if status & 0xF0 == 0x90 and p2 > 0:
+				note_ons.add((tr, status & 0x0F, time))
+
+	def close(seg):
+		tr, ix, start, lo, hi, value = seg
+		tol = seg_tolerance(res[tr].status[ix] & 0x0F)
+		value = min(max(value, hi - tol), lo + tol)
+		res[tr].data1[ix] = value & 0x7F
+		res[tr].data2[ix] = value >> 7
+	def seg_tolerance(ch):
+		# in wheel steps, of which there are 8192 to however many semitones the bend range is
+		return int(max_error / 100 * 8192 / bend_range(ch))
+
+	def track_bends(tr):
+		track = res[tr]
+		return ((time, tr, ix) for ix, (time, status) in enumerate(zip(track.time, track.status)) if status & 0xF0 == 0xE0)
+	bends = heapq.merge(*(track_bends(tr) for tr in range(len(res))))
+	segments = {}  # channel: [track, index of the bend kept, its time, lowest, highest, preferred value]
+	for time, tr, ix in bends:
+		track = res[tr]
+		ch = track.status[ix] & 0x0F
+		value = track.data2[ix] << 7 | track.data1[ix]
+		seg = segments.get(ch)
+		if seg is not None and seg[0] == tr:
+			if time - seg[2] < min_spacing and (tr, ch, time) not in note_ons:
+				seg[3:] = value, value, value
+				keep[tr][ix] = False
+				continue
+			if max(seg[4], value) - min(seg[3], value) <= 2 * seg_tolerance(ch):
+				seg[3] = min(seg[3], value)
+				seg[4] = max(seg[4], value)
+				keep[tr][ix] = False
+				continue
+		if seg is not None:
+			close(seg)
+		segments[ch] = [tr, ix, time, value, value, value]
+	for seg in segments.values():
+		close(seg)
+	return [track.filter(k) for track, k in zip(res, keep)], sum(k.count(False) for k in keep)
@@ -1,3 +1,4 @@
+from collections.abc import Sequence
 from enum import Enum
 from io import BytesIO
 import struct
@@ -201,10 +202,6 @@ class BinaryReader(Protocol):
 class BinaryWriter(Protocol):
 	def write(self, data: bytes) -> None:
 		...
-	def seek(self, offset: int, whence: int = 0) -> None:
-		...
-	def tell(self) -> int:
-		...
 
 def _read(fp: BinaryReader, n: int = -1) -> bytes:
 	res = []
@@ -266,7 +263,7 @@ def _get_chunk(fp: BinaryReader, littleend: bool = False) -> tuple[bytes, int, _
 CHUNK_HEADER = b"MThd"
 CHUNK_TRACK = b"MTrk"
 
-def parse_midi_file(fp: BinaryReader) -> MidiFile:
+def _parse_midi_header(fp: BinaryReader) -> tuple[MidiFileType, int | SMPTE, int]:
 	chunk_hdr, chunk_len, chunk_fp = _get_chunk(fp)
 	if chunk_hdr != CHUNK_HEADER:
 		raise ValueError("Does not start with MIDI header chunk")
@@ -276,86 +273,179 @@ def parse_midi_file(fp: BinaryReader) -> MidiFile:
 		type, ntracks, rate = struct.unpack(">HHH", _read(chunk_fp))
 	if rate < 0:
 		rate = SMPTE(((-rate) & 0xFF00) >> 8, rate & 0xFF)
-	midi_file = MidiFile(MidiFileType(type), rate, [])
+	return MidiFileType(type), rate, ntracks
+
+def parse_midi_file(fp: BinaryReader) -> MidiFile:
+	type, rate, ntracks = _parse_midi_header(fp)
+	midi_file = MidiFile(type, rate, [])
 
 	for i in range(ntracks):
 		chunk_hdr, chunk_len, chunk_fp = _get_chunk(fp)
 		if chunk_hdr != CHUNK_TRACK:
 			raise ValueError("Does not have expected MIDI track chunk")
 		with chunk_fp:
-			midi_file.tracks.append(list(parse_midi_track(chunk_fp)))
+			midi_file.tracks.append(parse_midi_track_data(_read(chunk_fp)))
 
 	return midi_file
 
-def _parse_variable_length(fp: BinaryReader) -> int:
+class _LazyTracks(Sequence[MidiTrack]):
+	def __init__(self, fp: BinaryReader, index: list[tuple[int, int]], cache: bool):
+		self.fp = fp
+		self.index = index
+		self.cache: Optional[list[Optional[MidiTrack]]] = [None] * len(index) if cache else None
+
+	def __len__(self) -> int:
+		return len(self.index)
+
+	def __getitem__(self, ix):
+		if isinstance(ix, slice):
+			return [self[i] for i in range(*ix.indices(len(self)))]
+		if ix < 0:
+			ix += len(self)
+		if not 0 <= ix < len(self):
+			raise IndexError("track index out of range")
+		if self.cache is not None and self.cache[ix] is not None:
+			return self.cache[ix]
+		offset, length = self.index[ix]
+		self.fp.seek(offset)
+		with _ChunkReader(self.fp, length) as chunk_fp:
+			track = parse_midi_track_data(_read(chunk_fp))
+		if self.cache is not None:
+			self.cache[ix] = track
+		return track
+
+class LazyMidiFile(NamedTuple):
+	# Same shape as MidiFile, but each track is only decoded the first time it's looked at.
+	# The file needs to stay open for as long as tracks are being accessed.
+	type: MidiFileType
+	rate: int | SMPTE
+	tracks: _LazyTracks
+
+	pprint = MidiFile.pprint
+
+	def load(self) -> MidiFile:
+		return MidiFile(self.type, self.rate, list(self.tracks))
+
+def parse_midi_file_lazy(fp: BinaryReader, cache: bool = True) -> LazyMidiFile:
+	type, rate, ntracks = _parse_midi_header(fp)
+	index = []
+	for i in range(ntracks):
+		chunk_hdr, chunk_len, chunk_fp = _get_chunk(fp)
+		if chunk_hdr != CHUNK_TRACK:
+			raise ValueError("Does not have expected MIDI track chunk")
+		index.append((chunk_fp.startpos, chunk_len))
+		# skip over the body without reading it
+		chunk_fp.seek(0, 2)
+	return LazyMidiFile(type, rate, _LazyTracks(fp, index, cache))
+
+def _parse_variable_length(data: memoryview, pos: int) -> tuple[int, int]:
 	n = 0
 	while True:
-		c, = _read(fp, 1)
+		c = data[pos]
+		pos += 1
 		n = n << 7 | (c & 0x7F)
 		if not c & 0x80:
 			break
-	return n
+	return n, pos
+
+_VLQ_CACHE_MAX = 1 << 14
+_vlq_cache: dict[int, bytes] = {}
 
 def _write_variable_length(n: int) -> bytes:
+	if n in _vlq_cache:
+		return _vlq_cache[n]
 	if n == 0:
 		return b"\0"
 	res = []
-	while n > 0:
-		res.append((n & 0x7F) | 0x80)
-		n >>= 7
+	m = n
+	while m > 0:
+		res.append((m & 0x7F) | 0x80)
+		m >>= 7
 	res.reverse()
 	res[-1] = res[-1] & 0x7F
-	return bytes(res)
+	res = bytes(res)
+	if n < _VLQ_CACHE_MAX:
+		# deltas are almost all small, so only cache those
+		_vlq_cache[n] = res
+	return res
 
 def parse_midi_track(fp: BinaryReader) -> Iterable[TimedMidiEvent]:
+	return parse_midi_track_data(_read(fp))
+
+def _take(data: memoryview, pos: int, n: int) -> bytes:
+	if pos + n > len(data):
+		raise EOFError()
+	return bytes(data[pos:pos+n])
+
+def parse_midi_track_data(data: bytes | memoryview) -> list[TimedMidiEvent]:
+	# decodes straight out of the buffer with a cursor, rather than going through a file object a byte at a time
+	data = memoryview(data)
+	end = len(data)
+	pos = 0
+	res = []
 	timer = 0
 	last_event = None
-	while True:
-		try:
-			offset = _parse_variable_length(fp)
-		except EOFError:
-			break
-		timer += offset
-
-		event, = _read(fp, 1)
-		if not event & 0x80:
-			if last_event is None:
-				raise ValueError("No event to continue from")
-			fp.seek(-1, 1)
-			event = last_event
-
-		if event < 0xF0:
-			last_event = event
-		else:
-			last_event = None
+	try:
+		while pos < end:
+			offset = data[pos]
+			if offset & 0x80:
+				try:
+					offset, pos = _parse_variable_length(data, pos)
+				except IndexError:
+					break
+			else:
+				pos += 1
+			timer += offset
+
+			event = data[pos]
+			if not event & 0x80:
+				if last_event is None:
+					raise ValueError("No event to continue from")
+				event = last_event
+			else:
+				pos += 1
 
-		if 0x80 <= event < 0xC0 or 0xE0 <= event < 0xF0:
-			p1, p2 = _read(fp, 2)
-			yield TimedMidiEvent(timer, decode_midi_event(event, p1, p2))
-		elif 0xC0 <= event < 0xE0:
-			p1, = _read(fp, 1)
-			yield TimedMidiEvent(timer, decode_midi_event(event, p1, None))
-		elif event == 0xF0 or event == 0xF7:
-			length = _parse_variable_length(fp)
-			if length == 0:
-				raise ValueError("Zero-length system-exclusive")
-			data = _read(fp, length)
-			device_id = data[0]
-			terminal = length > 1 and data[-1] == 0xF7
-			if terminal:
-				data = data[1:-1]
+			if event < 0xF0:
+				last_event = event
 			else:
-				data = data[1:]
-			yield TimedMidiEvent(timer, SysEx(device_id, data, terminal))
-		elif event == 0xFF:
-			type, = _read(fp, 1)
-			length, = _read(fp, 1)
-			data = _read(fp, length)
-			yield TimedMidiEvent(timer, MetaEvent(type, data))
-			if type == Events.END_OF_TRACK:
-				break
-		else:
-			raise ValueError("Unrecognised event")
+				last_event = None
+
+			if 0x80 <= event < 0xC0 or 0xE0 <= event < 0xF0:
+				p1 = data[pos]
+				p2 = data[pos+1]
+				pos += 2
+				res.append(TimedMidiEvent(timer, decode_midi_event(event, p1, p2)))
+			elif 0xC0 <= event < 0xE0:
+				p1 = data[pos]
+				pos += 1
+				res.append(TimedMidiEvent(timer, decode_midi_event(event, p1, None)))
+			elif event == 0xF0 or event == 0xF7:
+				length, pos = _parse_variable_length(data, pos)
+				if length == 0:
+					raise ValueError("Zero-length system-exclusive")
+				payload = _take(data, pos, length)
+				pos += length
+				device_id = payload[0]
+				terminal = length > 1 and payload[-1] == 0xF7
+				if terminal:
+					payload = payload[1:-1]
+				else:
+					payload = payload[1:]
+				res.append(TimedMidiEvent(timer, SysEx(device_id, payload, terminal)))
+			elif event == 0xFF:
+				type = data[pos]
+				length = data[pos+1]
+				pos += 2
+				payload = _take(data, pos, length)
+				pos += length
+				res.append(TimedMidiEvent(timer, MetaEvent(type, payload)))
+				if type == Events.END_OF_TRACK:
+					break
+			else:
+				raise ValueError("Unrecognised event")
+	except IndexError:
+		raise EOFError()
+	return res
 
 def write_midi_file(fp: BinaryWriter, midi: MidiFile) -> None:
 	if isinstance(midi.rate, int):
@@ -363,61 +453,58 @@ def write_midi_file(fp: BinaryWriter, midi: MidiFile) -> None:
 	elif isinstance(midi.rate, SMPTE):
 		rate = ((-midi.rate.fps) & 0xFF) << 8 | (midi.rate.tpf & 0xFF)
 	header = struct.pack(">HHH", midi.type.value, len(midi.tracks), rate)
-	_write_chunk(fp, CHUNK_HEADER, [header])
+	_write_chunk(fp, CHUNK_HEADER, header)
 	for track in midi.tracks:
 		_write_chunk(fp, CHUNK_TRACK, write_midi_track(track))
 
-def _write_chunk(fp: BinaryWriter, chunk_type: bytes, chunk_data: Iterable[bytes], littleend: bool = False) -> None:
-	fp.write(chunk_type)
-	chunk_len_loc = fp.tell()
-	fp.write(b"\0\0\0\0")
-	chunk_len = 0
-	for dat in chunk_data:
-		fp.write(dat)
-		chunk_len += len(dat)
-	chunk_end_loc = fp.tell()
-	fp.seek(chunk_len_loc)
-	fp.write(struct.pack("<L" if littleend else ">L", chunk_len))
-	fp.seek(chunk_end_loc)
-
-def write_midi_track(track: MidiTrack, abbrev: bool = True) -> Iterable[bytes]:
+def _write_chunk(fp: BinaryWriter, chunk_type: bytes, chunk_data: bytes, littleend: bool = False) -> None:
+	# length is known up front, so this is one write with no seeking, and works on pipes
+	fp.write(b"".join((chunk_type, struct.pack("<L" if littleend else ">L", len(chunk_data)), chunk_data)))
+
+def write_midi_track(track: MidiTrack, abbrev: bool = True) -> bytes:
+	if not isinstance(track, list):
+		track = list(track)
+	if any(track[i].time > track[i+1].time for i in range(len(track) - 1)):
+		track = sorted(track, key=lambda event: event.time)
+	vlq = _write_variable_length
+	res = bytearray()
 	offset = 0
-	track = list(track)
-	track.sort(key=lambda event: event.time)
 	last_event = None
 	sysex_cont = False
 	saw_end_of_track = False
-	for i, event in enumerate(track):
-		yield _write_variable_length(event.time - offset)
-		offset = event.time
+	for i, (time, event) in enumerate(track):
+		res += vlq(time - offset)
+		offset = time
 
-		if isinstance(event.event, SysEx):
+		if isinstance(event, SysEx):
 			last_event = None
-			yield b"\xF7" if sysex_cont else b"\xF0"
+			res.append(0xF7 if sysex_cont else 0xF0)
 			next_event = track[i+1].event if i+1 < len(track) else None
-			sysex_cont = event.event.terminal or not isinstance(next_event, SysEx) or next_event.device_id != event.event.device_id
-			payload = bytes([event.event.device_id]) + event.event.message
+			sysex_cont = event.terminal or not isinstance(next_event, SysEx) or next_event.device_id != event.device_id
+			payload = bytes([event.device_id]) + event.message
 			if not sysex_cont:
 				payload += b"\xF7"
-			yield bytes([len(payload)])
-			yield payload
-		elif isinstance(event.event, MetaEvent):
+			res.append(len(payload))
+			res += payload
+		elif isinstance(event, MetaEvent):
 			last_event = None
-			yield b"\xFF"
-			yield bytes([event.event.event, len(event.event.data)])
-			yield event.event.data
-			if event.event.event == Events.END_OF_TRACK:
+			res.append(0xFF)
+			res.append(event.event)
+			res.append(len(event.data))
+			res += event.data
+			if event.event == Events.END_OF_TRACK:
 				saw_end_of_track = True
 		else:
-			ev, p1, p2 = encode_midi_event(event.event)
+			ev, p1, p2 = encode_midi_event(event)
 			if ev != last_event or not abbrev:
-				yield bytes([ev])
+				res.append(ev)
 			last_event = ev
-			yield bytes([p1])
+			res.append(p1)
 			if p2 is not None:
-				yield bytes([p2])
+				res.append(p2)
 	if not saw_end_of_track:
-		yield b"\x00\xFF\x2F\x00"
+		res += b"\x00\xFF\x2F\x00"
+	return res
 
 def decode_midi_event(ev: int, p1: int, p2: Optional[int]) -> MidiEvent:
 	channel = ev & 0xF
@@ -491,22 +578,28 @@ def parse_mds_file(fp: BinaryReader) -> MidiFile:
 			print(subchunk_hdr)
 			raise ValueError("Did not find MIDS body")
 		with subchunk_fp:
-			num_blocks, = struct.unpack("<L", _read(subchunk_fp, 4))
-			offet = 0
-			for i in range(num_blocks):
-				offset, block_len = struct.unpack("<LL", _read(subchunk_fp, 8))
-				with _ChunkReader(subchunk_fp, block_len) as block_fp:
-					while True:
-						try:
-							delta, streamid, event = struct.unpack("<Ll4s", _read(block_fp, 12))
-						except EOFError:
-							break
-						offset += delta
-						if event[3] == 0:
-							track.append(TimedMidiEvent(offset, decode_midi_event(*event[:3])))
-						elif event[3] == 1:
-							track.append(TimedMidiEvent(offset, MetaEvent(Events.TEMPO, event[2::-1])))
-						else:
-							raise ValueError("Unrecognised event type")
-			track.append(TimedMidiEvent(offset, MetaEvent(Events.END_OF_TRACK, b"")))
+			body = memoryview(_read(subchunk_fp))
+		if len(body) < 4:
+			raise EOFError()
+		num_blocks, = struct.unpack_from("<L", body)
+		pos = 4
+		# so a file with no blocks still gets its end of track, at 0
+		offset = 0
+		for i in range(num_blocks):
+			if pos + 8 > len(body):
+				raise EOFError()
+			offset, block_len = struct.unpack_from("<LL", body, pos)
+			pos += 8
+			block = body[pos:pos+block_len]
+			pos += block_len
+			# any trailing partial record is ignored
+			for delta, streamid, ev, p1, p2, kind in struct.iter_unpack("<LlBBBB", block[:len(block) - len(block) % 12]):
+				offset += delta
+				if kind == 0:
+					track.append(TimedMidiEvent(offset, decode_midi_event(ev, p1, p2)))
+				elif kind == 1:
+					track.append(TimedMidiEvent(offset, MetaEvent(Events.TEMPO, bytes((p2, p1, ev)))))
+				else:
+					raise ValueError("Unrecognised event type")
+		track.append(TimedMidiEvent(offset, MetaEvent(Events.END_OF_TRACK, b"")))
 	return MidiFile(MidiFileType.SINGLETRACK, rate, [track])
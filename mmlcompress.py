@@ -0,0 +1,174 @@
+# Find repeated runs of notes in generated MML (see mmlgen.py) and turn them into AddmusicK
+# loops, ie (1)[...] the first time and (1) every time after, to cut down the sequence size.
+# All the channels of a song go into one suffix array, so a run can be shared between channels.
+# Each round takes whichever repeat saves the most bytes, swaps it out, and starts again, until
+# there's nothing left worth doing.
+# The engine can't call a loop from inside another loop, so a repeat never contains a loop; each
+# one that's been swapped out is treated as a symbol that matches nothing else.
+from dataclasses import dataclass
+
+import numpy as np
+
+MIN_LENGTH = 2  # notes
+# what a loop costs, in bytes, the same as aram.py counts them: the first time, the call and the
+# end of the loop body, and just the call every time after
+DEFINE_BYTES = 5
+CALL_BYTES = 4
+TIE = -1
+
+@dataclass
+class Loop:
+	label: int
+	count: int
+	body: list | None  # None for a call back to a loop defined earlier
+	newline: bool
+	end_wheel: int  # the tuning the body leaves the channel at
+
+def token_key(item):
+	# what has to match for two notes to be the same: the tuning only matters for actual notes
+	startts, endts, note, wheel, newline = item
+	return note, endts - startts, wheel if note is not None and note != TIE else 0
+
+def token_cost(items):
+	# roughly what each note compiles to: the note, its length, and a $EE if the tuning changed
+	res = []
+	cur_wheel = None
+	for startts, endts, note, wheel, newline in items:
+		cost = 2
+		if note is not None and note != TIE and wheel != cur_wheel:
+			cost += 2
+			cur_wheel = wheel
+		res.append(cost)
+	return res
+
+def suffix_array(seq):
+	# prefix doubling, sorting on (rank, rank k along) each time
+	n = len(seq)
+	rank = np.unique(seq, return_inverse=True)[1].astype(np.int64)
+	k = 1
+	while True:
+		second = np.full(n, -1, dtype=np.int64)
+		if k < n:
+			second[:n - k] = rank[k:]
+		sa = np.lexsort((second, rank))
+		changed = np.concatenate([[0], (np.diff(rank[sa]) != 0) | (np.diff(second[sa]) != 0)])
+		new_rank = np.empty(n, dtype=np.int64)
+		new_rank[sa] = np.cumsum(changed)
+		rank = new_rank
+		if rank.max() == n - 1 or k >= n:
+			return sa
+		k *= 2
+
+def lcp_array(seq, sa):
+	# Kasai et al: lcp[i] is the common prefix of the suffixes at sa[i-1] and sa[i]
+	n = len(seq)
+	rank = [0] * n
+	for i, pos in enumerate(sa):
+		rank[pos] = i
+	lcp = [0] * n
+	h = 0
+	for pos in range(n):
+		if rank[pos]:
+			prev = sa[rank[pos] - 1]
+			while pos + h < n and prev + h < n and seq[pos + h] == seq[prev + h]:
+				h += 1
+			lcp[rank[pos]] = h
+			if h:
+				h -= 1
+		else:
+			h = 0
+	return lcp
+
+def repeats(seq):
+	# every maximal repeat, as (length, start positions), from the LCP intervals
+	sa = suffix_array(np.array(seq)).tolist()
+	lcp = lcp_array(seq, sa)
+	stack = [(0, 0)]  # (lcp, left end of the interval)
+	for i in range(1, len(sa) + 1):
+		h = lcp[i] if i < len(sa) else 0
+		left = i - 1
+		while stack[-1][0] > h:
+			length, left = stack.pop()
+			if length >= MIN_LENGTH:
+				yield length, sa[left:i]
+		if stack[-1][0] < h:
+			stack.append((h, left))
+
+def best_repeat(seq, costs, valid_start, valid_end):
+	# the repeat that saves the most, as (saving, length, positions)
+	prefix = np.concatenate([[0], np.cumsum(costs)])
+	best = (0, None, None)
+	for length, positions in repeats(seq):
+		positions = sorted(i for i in positions if valid_start[i] and valid_end[i + length])
+		# as many as fit without overlapping, counting runs of back-to-back repeats as one call
+		chosen = []
+		calls = 0
+		for pos in positions:
+			if chosen and pos < chosen[-1] + length:
+				continue
+			if not chosen or pos != chosen[-1] + length:
+				calls += 1
+			chosen.append(pos)
+		if len(chosen) < 2:
+			continue
+		body = prefix[chosen[0] + length] - prefix[chosen[0]]
+		saving = body * (len(chosen) - 1) - DEFINE_BYTES - CALL_BYTES * (calls - 1)
+		if saving > best[0]:
+			best = (saving, length, chosen)
+	return best
+
+def compress(channels):
+	# channels: lists of notes as they come out of mmlgen.filter_notes
+	# returns the same, with some runs of notes swapped for Loops
+	items = []
+	seq = []
+	costs = []
+	for channel in channels:
+		channel = list(channel)
+		items.extend(channel)
+		seq.extend(token_key(i) for i in channel)
+		costs.extend(token_cost(channel))
+		# a separator, so no repeat runs from one channel into the next
+		items.append(None)
+		seq.append(("end", len(items)))
+		costs.append(0)
+	keys = {}
+	seq = [keys.setdefault(i, len(keys)) for i in seq]
+	next_symbol = len(keys)
+
+	label = 0
+	while True:
+		# a loop can't start with a tie, or be followed by one, since the tie needs the note before it
+		is_tie = [isinstance(i, tuple) and i[2] == TIE for i in items] + [False]
+		is_item = [isinstance(i, tuple) for i in items]
+		saving, length, positions = best_repeat(seq, costs, [a and not b for a, b in zip(is_item, is_tie)], [not i for i in is_tie])
+		if not saving:
+			break
+		label += 1
+		body = items[positions[0]:positions[0] + length]
+		end_wheel = next((i[3] for i in reversed(body) if i[2] is not None and i[2] != TIE), -10)
+		# back-to-back repeats become one loop played more than once
+		runs = []
+		for pos in positions:
+			if runs and pos == runs[-1][0] + runs[-1][1] * length:
+				runs[-1][1] += 1
+			else:
+				runs.append([pos, 1])
+		for ix, (pos, count) in reversed(list(enumerate(runs))):
+			loop = Loop(label, count, body if ix == 0 else None, items[pos][4], end_wheel)
+			end = pos + count * length
+			items[pos:end] = [loop]
+			# every loop is its own symbol, that never matches anything
+			seq[pos:end] = [next_symbol]
+			next_symbol += 1
+			costs[pos:end] = [CALL_BYTES]
+
+	res = []
+	channel = []
+	for item in items:
+		if item is None:
+			res.append(channel)
+			channel = []
+		else:
+			channel.append(item)
+	return res
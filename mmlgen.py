@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# Draft AddmusicK MML straight from the MIDI that go.py makes, the way 09-gen.py first did for
+# Trident's Stage, but for any song.
+#   ./mmlgen.py [--loops] [SONGNUM ...]
+# Writes out/*/draft.txt: each track (or whatever SELECTIONS says) on its own MML channel, every
+# note at its pitch, with a $EE tuning to get it the rest of the way there, and a line per bar.
+import glob
+import heapq
+import io
+import os
+import sys
+import time
+from bisect import bisect_right
+
+import aram
+import go
+import midifile
+import mmlcompress
+
+SCALE = go.MIDI_TICKRATE // 48  # AddmusicK has 48 ticks to a quarter note
+OCTAVE_OFFSET = 2  # MIDI note 60 is o3c
+MML_CHANNELS = 8
+# find the repeats and put them in loops (--loops)
+LOOPS = False
+NOTE_NAMES = ["c", "c+", "d", "d+", "e", "f", "f+", "g", "g+", "a", "a+", "b"]
+
+# which notes go on which MML channel, per song, as {(track, MIDI channel): MML channel}, where a
+# MIDI channel of None takes everything on the track. Songs not in here get a channel per track.
+SELECTIONS = {}
+
+def merge_tracks(mid, tracks):
+	# the tracks are each already in order, so they only need merging, not sorting;
+	# ties stay in track order, same as a stable sort would leave them
+	def tagged(ix):
+		for ev in mid.tracks[ix]:
+			yield ix, ev
+	return heapq.merge(*(tagged(ix) for ix in tracks), key=lambda i: i[1].time)
+
+def gen_notes(events, selection):
+	# returns [start, end, note, wheel] for each MML channel, with note None for a rest
+	notes = [[] for i in range(max(selection.values()) + 1)]
+	wheel = {}
+	cur_src = [None] * len(notes)
+	end = 0
+
+	def end_note(ch, time):
+		if notes[ch] and notes[ch][-1][1] is None:
+			notes[ch][-1][1] = round(time / SCALE)
+	def add_note(ch, time, note, wheel):
+		end_note(ch, time)
+		if note is not None:
+			# only the fraction of a semitone goes in the tuning
+			semitones, wheel = divmod(wheel, 256)
+			note += semitones
+		notes[ch].append([round(time / SCALE), None, note, wheel])
+
+	for ch in range(len(notes)):
+		add_note(ch, 0, None, 0)
+
+	for track, ev in events:
+		if isinstance(ev.event, midifile.MetaEvent):
+			if ev.event.event == midifile.Events.END_OF_TRACK:
+				end = max(end, ev.time)
+			continue
+		src = (track, ev.event.channel)
+		ch = selection.get(src, selection.get((track, None)))
+		if ch is None:
+			continue
+		if isinstance(ev.event, midifile.NoteOn):
+			add_note(ch, ev.time, ev.event.key, wheel.get(src, 0))
+			cur_src[ch] = src
+		elif isinstance(ev.event, midifile.NoteOff):
+			# a note that's already been cut off by another one doesn't end that one too
+			if src == cur_src[ch]:
+				add_note(ch, ev.time, None, wheel.get(src, 0))
+				cur_src[ch] = None
+		elif isinstance(ev.event, midifile.Wheel):
+			wheel[src] = round((ev.event.wheel - 8192) / 8192 * 256 * go.bend_range(ev.event.channel))
+	for ch in range(len(notes)):
+		end_note(ch, end)
+	return notes
+
+def bar_lines(songnum, end):
+	# where each bar starts, in AddmusicK ticks, from the song's time signatures
+	res = []
+	ts = 0
+	for i in go.TIMESIG[songnum]:
+		length = (go.MIDI_TICKRATE * 4 * i[0] >> i[1]) // SCALE
+		count = i[2] if len(i) >= 3 else None
+		while ts <= end and (count is None or count > 0):
+			res.append(ts)
+			ts += length
+			if count is not None:
+				count -= 1
+	return res
+
+def split_barlines(notes, bars):
+	for startts, endts, note, wheel in notes:
+		# the last bar line the note runs over, if any
+		bar = bars[bisect_right(bars, endts) - 1]
+		if bar > startts:
+			yield startts, bar, note, wheel, False
+			yield bar, endts, None if note is None else -1, wheel, True
+		else:
+			yield startts, endts, note, wheel, False
+
+def filter_notes(notes):
+	carry_newline = True
+	for startts, endts, note, wheel, newline in notes:
+		carry_newline = carry_newline or newline
+		if startts != endts:
+			yield startts, endts, note, wheel, carry_newline
+			carry_newline = False
+
+def gen_output(fp, notes, octave_offset=OCTAVE_OFFSET):
+	_write_notes(fp, notes, octave_offset, -10)
+	fp.write("\n")
+
+def _write_notes(fp, notes, octave_offset, cur_wheel):
+	# returns the tuning it leaves the channel at
+	first = True
+	for item in notes:
+		if isinstance(item, mmlcompress.Loop):
+			newline = item.newline
+		else:
+			startts, endts, note, wheel, newline = item
+		if not first:
+			if newline:
+				fp.write("\n")
+			else:
+				fp.write(" ")
+		first = False
+		if isinstance(item, mmlcompress.Loop):
+			fp.write(f"({item.label})")
+			if item.body is not None:
+				# it gets played from all over, so it can't count on whatever tuning came before
+				fp.write("[")
+				_write_notes(fp, item.body, octave_offset, -10)
+				fp.write("]")
+			if item.count > 1:
+				fp.write(str(item.count))
+			cur_wheel = item.end_wheel
+			continue
+		if note is not None and abs(wheel - cur_wheel):
+			fp.write(f"$EE ${wheel:02X} ")
+			cur_wheel = wheel
+		if note is None:
+			fp.write("r")
+		elif note == -1:
+			fp.write("^")
+		else:
+			octave, note = divmod(note, 12)
+			fp.write(f"o{octave - octave_offset}{NOTE_NAMES[note]}")
+		fp.write(f"={endts - startts}")
+	return cur_wheel
+
+def track_names(mid):
+	# the name of each track that has any notes in it
+	res = {}
+	for ix, track in enumerate(mid.tracks):
+		name = f"track {ix}"
+		for ev in track:
+			if isinstance(ev.event, midifile.MetaEvent) and ev.event.event == midifile.Events.TRACK_NAME:
+				name = ev.event.data.decode("utf-8")
+			elif isinstance(ev.event, midifile.NoteOn):
+				res[ix] = name
+				break
+	return res
+
+def channel_notes(mid, songnum, selection):
+	# the bar-split, ready to output notes for each MML channel
+	tracks = sorted({track % len(mid.tracks) for track, ch in selection})
+	selection = {(track % len(mid.tracks), ch): out for (track, ch), out in selection.items()}
+	notes = gen_notes(merge_tracks(mid, tracks), selection)
+	end = max(channel[-1][1] for channel in notes)
+	bars = bar_lines(songnum, end)
+	return [filter_notes(split_barlines(channel, bars)) for channel in notes]
+
+def sequence_size(text):
+	estimate = aram.SequenceEstimate()
+	estimate.feed(aram.strip_mml(text))
+	return estimate.size
+
+def write_draft(fp, channels, names):
+	for ch, (notes, srcs) in enumerate(zip(channels, names)):
+		if ch < MML_CHANNELS:
+			fp.write(f"#{ch} ; {srcs}\n")
+			gen_output(fp, notes)
+		else:
+			# anything past the eighth channel is still written out, to be fitted in by hand, but
+			# commented out, or AddmusicK would tack it onto the end of #7
+			fp.write(f"; (no channel left) {srcs}\n")
+			buf = io.StringIO()
+			gen_output(buf, notes)
+			fp.write("".join(f"; {line}" for line in buf.getvalue().splitlines(True)))
+		fp.write("\n\n")
+
+def draft_song(dn):
+	songnum = int(os.path.basename(dn)[:2])
+	with open(os.path.join(dn, "output.mid"), "rb") as fp:
+		mid = midifile.parse_midi_file_lazy(fp, cache=True)
+		names = track_names(mid)
+		selection = SELECTIONS.get(songnum) or {(track, None): ix for ix, track in enumerate(names)}
+		channels = [list(i) for i in channel_notes(mid, songnum, selection)]
+		srcs = [
+			", ".join(names.get(track % len(mid.tracks), f"track {track % len(mid.tracks)}") for (track, _), i in selection.items() if i == ch)
+			for ch in range(len(channels))
+		]
+	if LOOPS:
+		before = io.StringIO()
+		write_draft(before, channels, srcs)
+		# only the channels that actually get played, so nothing's looped in with one that doesn't
+		channels = mmlcompress.compress(channels[:MML_CHANNELS]) + channels[MML_CHANNELS:]
+	with open(os.path.join(dn, "draft.txt"), "w") as fp:
+		write_draft(fp, channels, srcs)
+	if LOOPS:
+		with open(os.path.join(dn, "draft.txt")) as fp:
+			after = sequence_size(fp.read())
+		before = sequence_size(before.getvalue())
+		print(f"{os.path.basename(dn):40s} ~{before:6,d} -> ~{after:6,d} bytes ({after - before:+,d})")
+
+def main():
+	only = set(map(int, sys.argv[1:]))
+	dns = [i for i in sorted(glob.glob(os.path.join(go.OUTDIR, "[0-9][0-9]*"))) if not only or int(os.path.basename(i)[:2]) in only]
+	start = time.perf_counter()
+	for dn in dns:
+		draft_song(dn)
+	print(f"{len(dns)} songs drafted in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+	if "--loops" in sys.argv:
+		sys.argv.remove("--loops")
+		LOOPS = True
+	main()
@@ -1,115 +1,230 @@
-#!/usr/bin/python3.13
+#!/usr/bin/python
 import os
+import glob
 import math
 import itertools
+import functools
+import collections
+import sys
+import time
+
+import numpy as np
+
+from constants import RATE
+from vgm import read_file
+from psg import process_psg
 
 THRESHOLD=0.1  # let notes be 10 cents out of tune
+BASE_PERIOD=32  # the period of the root note, which the instrument tunings in the songs expect
+SEARCH_BLOCK=4096  # how many sample lengths to try at once
+# length has to be a multiple of this... 32 is what all the existing samples were made with, but
+# BRR only actually needs whole blocks of 16 (see --shortest)
+LENGTH_STEP=32
+BRR_LENGTH_STEP=16
+# go for the shortest BRR that's in tune, rather than a multiple of 32 (--shortest)
+SHORTEST=False
+# regenerate the samples even if they're already there (--force)
+FORCE=False
+# for --scan: chords shorter than a frame are just the channels changing notes at slightly different
+# times, not something that's actually meant to be heard
+MIN_CHORD_SECONDS=1/60
+MAX_CHORD_SPAN=12
 
-def gen_squares(*pitches):
+def chord_filename(pitches):
 	if pitches == (0,):
-		fn = "square.brr"
-	else:
-		strpitches = "-".join(map(str, pitches))
-		fn = f"square-{strpitches}.brr"
-	if os.path.exists(f"inst/{fn}"):
+		return "square.brr"
+	strpitches = "-".join(map(str, pitches))
+	return f"square-{strpitches}.brr"
+
+def gen_squares(*pitches):
+	fn = chord_filename(pitches)
+	if os.path.exists(f"inst/{fn}") and not FORCE:
 		return
 
-	samples = gen_samples(pitches)
-	brr = gen_brr(samples)
+	brr = gen_brr(gen_samples(pitches))
 	with open(f"inst/{fn}", "wb") as fp:
-		for dat in brr:
-			fp.write(dat)
+		fp.write(brr)
 
 	if not os.path.exists(f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/{fn}"):
 		os.symlink(f"/home/phlip/eternalchampions/inst/{fn}", f"/home/phlip/smwhack/AddmusicK_1.0.11/samples/eternalchampions/{fn}")
 
 def gen_samples(pitches):
 	samplen, periods = find_samplen(pitches)
-	for i in range(samplen):
-		v = 0
-		for p in periods:
-			if (i % p) * 2 < p:
-				v += 1
-			else:
-				v -= 1
-		yield round(v * 7 / len(pitches))
+	# +1 for each note that's in the high half of its cycle, -1 for the low half
+	i = np.arange(samplen)[:, None]
+	v = np.where((i % periods) * 2 < periods, 1, -1).sum(axis=1)
+	return np.round(v * 7 / len(pitches)).astype(np.int8)
 
 def find_samplen(pitches):
 	# find a short length that's close enough to a multiple of the required pitches
-	target_periods = [32/2**(i/12) for i in pitches]
-	for samplen in itertools.count(32, 32):
-		periods = [samplen/round(samplen/i) for i in target_periods]
-		offsets = [math.log(32/p)/math.log(2)*12 - pitch for p, pitch in zip(periods, pitches)]
-		if all(abs(i) < THRESHOLD for i in offsets):
-			#print(pitches, samplen, offsets)
-			return samplen, periods
-
-def islast(seq):
-	# not sure why this isn't in itertools tbh
-	prev = None
-	has_prev = False
-	for i in seq:
-		if has_prev:
-			yield prev, False
-		prev = i
-		has_prev = True
-	if has_prev:
-		yield prev, True
+	# the answer doesn't depend on what order the notes are in, so only work it out once per chord
+	order = sorted(range(len(pitches)), key=lambda i: pitches[i])
+	step = BRR_LENGTH_STEP if SHORTEST else LENGTH_STEP
+	samplen, periods = _find_samplen(tuple(pitches[i] for i in order), step)
+	res = [None] * len(pitches)
+	for i, period in zip(order, periods):
+		res[i] = period
+	return samplen, res
+
+@functools.cache
+def _find_samplen(pitches, step):
+	# tries a whole block of lengths at a time, and takes the shortest one where every note is in tune
+	target_periods = BASE_PERIOD / 2 ** (np.array(pitches) / 12)
+	for start in itertools.count(step, step * SEARCH_BLOCK):
+		samplens = np.arange(start, start + step * SEARCH_BLOCK, step)[:, None]
+		# (at least one cycle, the shortest lengths can be shorter than the lowest note)
+		periods = samplens / np.maximum(np.round(samplens / target_periods), 1)
+		offsets = np.log2(BASE_PERIOD / periods) * 12 - pitches
+		good = np.all(np.abs(offsets) < THRESHOLD, axis=1)
+		if good.any():
+			ix = np.argmax(good)
+			return int(samplens[ix, 0]), periods[ix].tolist()
+
+def chord_offsets(pitches):
+	# how far out of tune (in semitones) each note ends up
+	samplen, periods = find_samplen(pitches)
+	return [math.log(BASE_PERIOD/p)/math.log(2)*12 - pitch for p, pitch in zip(periods, pitches)]
 
 def gen_brr(samples):
-	yield b'\0\0'
-	for block, last in islast(itertools.batched(samples, 16, strict=True)):
-		yield b'\xB3' if last else b'\xB0'
-		for a, b in itertools.batched(block, 2):
-			yield bytes([(a & 0xF) << 4 | (b & 0xF)])
+	# the whole file at once: the loop offset (0, it all loops), then each block's header (loop,
+	# and end on the last one) and its 16 samples, as 4-bit nibbles two to a byte
+	if len(samples) % 16:
+		raise ValueError(f"{len(samples)} samples isn't a whole number of BRR blocks")
+	nblocks = len(samples) // 16
+	res = bytearray(2 + nblocks * 9)
+	blocks = np.frombuffer(res, dtype=np.uint8, offset=2).reshape(nblocks, 9)
+	nibbles = (samples.astype(np.uint8) & 0xF).reshape(nblocks, 8, 2)
+	blocks[:, 0] = 0xB0
+	blocks[-1, 0] = 0xB3
+	blocks[:, 1:] = nibbles[:, :, 0] << 4 | nibbles[:, :, 1]
+	return res
 
-def main():
+def sounding_notes(hdr, state):
+	# the notes playing on the three tone channels, lowest first
+	notes = []
+	for ch in state[:3]:
+		if ch.volume < 15 and ch.value > 1 and (ch.stereo_l or ch.stereo_r):
+			notes.append(round(12 * math.log2(hdr.sn76489 / 32 / ch.value / 440) + 69))
+	return sorted(notes)
+
+def find_chords(hdr, psg):
+	# every chord shape the PSG plays (as intervals above the lowest note), with how many times
+	# it's played and for how long in total, in samples
+	counts = collections.Counter()
+	durations = collections.Counter()
+	notes = []
+	start = 0
+	for framenum, state in psg:
+		new_notes = sounding_notes(hdr, state) if state is not None else []
+		# a volume change on its own carries on the same chord
+		if new_notes == notes:
+			continue
+		if len(notes) > 1 and framenum - start >= MIN_CHORD_SECONDS * RATE:
+			shape = tuple(i - notes[0] for i in notes)
+			counts[shape] += 1
+			durations[shape] += framenum - start
+		notes = new_notes
+		start = framenum
+	return counts, durations
+
+def scan():
+	# what chord samples each song would need, for comparison against CHORDS
+	needed = {}
+	elapsed = 0
+	fns = sorted(glob.glob("[0-9][0-9]*.vgm"))
+	for fn in fns:
+		with open(fn, "rb") as fp:
+			hdr, gd3, commands = read_file(fp)
+		psg = list(process_psg(hdr, commands))
+		start = time.perf_counter()
+		counts, durations = find_chords(hdr, psg)
+		elapsed += time.perf_counter() - start
+		if not counts:
+			continue
+		print(fn)
+		song_needed = []
+		for shape in sorted(counts, key=lambda i: -durations[i]):
+			# anything wider than an octave is a bass line under a tune, not something to make a sample of
+			wide = shape[-1] > MAX_CHORD_SPAN
+			print(f"  {chord_filename(shape):20s} x{counts[shape]:<4d} {durations[shape] / RATE:6.2f}s{'  (too wide)' if wide else ''}")
+			if not wide:
+				song_needed.append(shape)
+		print(f"  needs: {' '.join(chord_filename(i) for i in sorted(song_needed))}")
+		needed.update(dict.fromkeys(song_needed))
+	missing = [i for i in sorted(needed) if i not in CHORDS]
+	print(f"{len(needed)} chord shapes, {len(missing)} not in CHORDS: {' '.join(chord_filename(i) for i in missing)}")
+	print(f"{len(fns)} songs analysed in {elapsed * 1000:.1f}ms")
+
+CHORDS = [
 	# basic square wave
-	gen_squares(0)
-	gen_squares(12) # 8va
+	(0,),
+	(12,), # 8va
 	# for 07 Jetta's Stage
-	gen_squares(0, 5, 8)  # F# B D
-	gen_squares(0, 4, 9)  # G B E
-	gen_squares(0, 2, 4)  # A B C#
-	gen_squares(0, 4, 4)  # G B B (doubled note = doubled volume in the chord)
-	gen_squares(0, 5, 9)  # G C E
-	gen_squares(0, 4, 7)  # F# A# C#
+	(0, 5, 8),  # F# B D
+	(0, 4, 9),  # G B E
+	(0, 2, 4),  # A B C#
+	(0, 4, 4),  # G B B (doubled note = doubled volume in the chord)
+	(0, 5, 9),  # G C E
+	(0, 4, 7),  # F# A# C#
 	# for 11 Midnight's Stage
-	gen_squares(0, 4, 9)  # Eb G C
-	gen_squares(0, 5, 9)  # Eb Ab C
-	gen_squares(0, 4, 8)  # E Ab C
-	gen_squares(0, 5, 7)  # F Bb C
-	gen_squares(0, 4, 6)  # Gb Bb C
-	gen_squares(0, 3, 6)  # Gb A C
-	gen_squares(0, 4, 7)  # Bb D F
-	gen_squares(0, 4, 9)  # Bb D G
-	gen_squares(0, 3, 8)  # C Eb Ab
-	gen_squares(0, 3, 12)  # C Eb C
-	gen_squares(0, 2, 12)  # Db Eb Db
-	gen_squares(0, 2, 11)  # Db Eb C
-	gen_squares(0, 5, 12)  # Bb Eb Bb
-	gen_squares(0, 4, 8)  # B Eb G
-	gen_squares(0, 3, 7)  # C Eb G
-	gen_squares(0, 3, 8)  # D F Bb
-	gen_squares(0, 5, 9)  # Db Gb Bb
-	gen_squares(0, 3, 10)  # C Eb Bb
+	(0, 4, 9),  # Eb G C
+	(0, 5, 9),  # Eb Ab C
+	(0, 4, 8),  # E Ab C
+	(0, 5, 7),  # F Bb C
+	(0, 4, 6),  # Gb Bb C
+	(0, 3, 6),  # Gb A C
+	(0, 4, 7),  # Bb D F
+	(0, 4, 9),  # Bb D G
+	(0, 3, 8),  # C Eb Ab
+	(0, 3, 12),  # C Eb C
+	(0, 2, 12),  # Db Eb Db
+	(0, 2, 11),  # Db Eb C
+	(0, 5, 12),  # Bb Eb Bb
+	(0, 4, 8),  # B Eb G
+	(0, 3, 7),  # C Eb G
+	(0, 3, 8),  # D F Bb
+	(0, 5, 9),  # Db Gb Bb
+	(0, 3, 10),  # C Eb Bb
 	# for 12 Larcen's Stage
-	gen_squares(0, 7)  # G D
-	gen_squares(0, 8)  # G Eb
-	gen_squares(0, 9)  # G E
-	gen_squares(0, 5)  # Bb Eb
+	(0, 7),  # G D
+	(0, 8),  # G Eb
+	(0, 9),  # G E
+	(0, 5),  # Bb Eb
 	# for 16 Good Ending
-	gen_squares(0, 2)
-	gen_squares(0, 3)
-	gen_squares(0, 4)
-	gen_squares(0, 12)
+	(0, 2),
+	(0, 3),
+	(0, 4),
+	(0, 12),
 	# for 01 main theme
-	gen_squares(0, 2, 7)
-	gen_squares(0, 3, 7)
-	gen_squares(0, 5, 8)
-	gen_squares(0, 5, 9)
-	gen_squares(0, 5, 12)
-	gen_squares(0, 7, 12)
+	(0, 2, 7),
+	(0, 3, 7),
+	(0, 5, 8),
+	(0, 5, 9),
+	(0, 5, 12),
+	(0, 7, 12),
+]
+
+def gen_all(chords):
+	# generate the whole set, each chord just the once, and report how much space they come to
+	total = 0
+	for pitches in dict.fromkeys(chords):
+		gen_squares(*pitches)
+		samplen, periods = find_samplen(pitches)
+		size = 2 + samplen // 16 * 9
+		total += size
+		worst = max(map(abs, chord_offsets(pitches))) * 100
+		print(f"{chord_filename(pitches):20s} {samplen:5d} samples {size:6,d} bytes, worst note {worst:4.1f} cents out")
+	print(f"Total: {total:,} bytes")
+
+def main():
+	if "--scan" in sys.argv:
+		scan()
+	else:
+		gen_all(CHORDS)
 
 if __name__ == "__main__":
+	if "--shortest" in sys.argv:
+		SHORTEST = True
+	if "--force" in sys.argv:
+		FORCE = True
 	main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# Pick sample rates for the instrument samples, rather than by trial and error:
+# the lowest rate that keeps all the audible harmonics of the recording, but no higher
+# than the SPC can play the highest note the songs actually use.
+#   ./rateopt.py [INST ...]
+import glob
+import sys
+from dataclasses import replace
+
+import numpy as np
+
+import build
+import dsp
+import ym
+from manifest import read_manifest, ORIGRATE
+from vgm import read_file
+
+LOST_DB = 25  # how far below the rest of the sound the (A-weighted) energy we throw away has to be
+SEGMENT = 4096
+RATE_STEP = 512
+# the range of rates the samples have always been built at; below this everything sounds muffled
+# whatever the spectrum says, and above it isn't worth the ARAM
+MINRATE = 4096
+MAXSAMPLERATE = 16384
+
+def song_note_ranges():
+	# highest note each instrument plays, across the whole soundtrack, keyed by the instrument
+	# number used for out/instNN_*.wav
+	res = {}
+	for fn in sorted(glob.glob("[0-9][0-9]*.vgm")):
+		with open(fn, "rb") as fp:
+			hdr, gd3, commands = read_file(fp)
+		ym.render_ym(hdr, list(ym.process_ym(hdr, commands)), None)
+		for inst in ym.song_instrumentlist:
+			ix = ym.all_instrumentmap[inst]
+			res[ix] = max(res.get(ix, 0), max(ym.song_instrumentnotes[inst]))
+	return res
+
+def a_weighting(freqs):
+	# IEC 61672 A-weighting, as a power ratio
+	f2 = freqs ** 2
+	ra = 12194**2 * f2**2 / ((f2 + 20.6**2) * np.sqrt((f2 + 107.7**2) * (f2 + 737.9**2)) * (f2 + 12194**2))
+	return ra ** 2
+
+def bandwidth(samples, lost_db=LOST_DB):
+	# the frequency that everything audible sits below: the A-weighted energy above it is lost_db
+	# below the total, from an averaged (Welch) power spectrum
+	if len(samples) < SEGMENT:
+		samples = np.concatenate([samples, np.zeros(SEGMENT - len(samples))])
+	nseg = (len(samples) - SEGMENT) // (SEGMENT // 2) + 1
+	ix = np.arange(nseg)[:, None] * (SEGMENT // 2) + np.arange(SEGMENT)[None, :]
+	power = (np.abs(np.fft.rfft(samples[ix] * np.hanning(SEGMENT), axis=1)) ** 2).mean(axis=0)
+	freqs = np.arange(len(power)) * ORIGRATE / SEGMENT
+	power = power * a_weighting(freqs)
+	if not power.sum():
+		return 0.0
+	cumulative = np.cumsum(power) / power.sum()
+	return float(freqs[np.searchsorted(cumulative, 1 - 10 ** (-lost_db / 10))])
+
+def spectral_rate(sample):
+	# enough that the resampler's passband covers the whole bandwidth
+	samples, _ = dsp.read_wav(sample.source)
+	samples = dsp.mix_mono(samples)[sample.start:sample.end]
+	return 2 * bandwidth(samples) / dsp.PASSBAND
+
+def optimize(sample, maxnote=None):
+	# returns the chosen rate, what the recording needs, and the most the pitch range allows
+	need = spectral_rate(sample)
+	ceiling = sample.max_rate(maxnote)
+	def fits(rate):
+		# the block rounding moves the real rate a little, and a short loop can round away to nothing
+		realrate, length, looplen, looppoint = replace(sample, rate=rate).layout()
+		if (looplen if looppoint is not None else length) <= 0:
+			return False
+		return ceiling is None or realrate <= ceiling
+	rates = list(range(MINRATE, MAXSAMPLERATE + 1, RATE_STEP))
+	wanted = [i for i in rates if i >= need and fits(i)]
+	if wanted:
+		rate = wanted[0]
+	else:
+		# can't have everything, so get as close to the spectrum as the pitch range allows
+		allowed = [i for i in rates if fits(i)]
+		if not allowed:
+			return sample.rate, need, ceiling
+		rate = allowed[-1]
+	# then, if the block rounding means a higher rate costs nothing, have it anyway
+	size = sample.brr_size(rate)
+	for i in rates:
+		if i > rate and fits(i) and sample.brr_size(i) == size:
+			rate = i
+	return rate, need, ceiling
+
+def main():
+	only = set(map(int, sys.argv[1:]))
+	samples = [i for i in read_manifest() if not only or i.inst in only]
+	ranges = song_note_ranges()
+	sizes_before = {}
+	sizes_after = {}
+	for sample in samples:
+		# samples with a transpose are played at a fixed pitch, so the songs' notes don't apply
+		maxnote = sample.maxnote
+		if maxnote is None and sample.transpose is None and sample.inst in ranges:
+			maxnote = round(ranges[sample.inst])
+		rate, need, ceiling = optimize(sample, maxnote)
+		before = sample.brr_size()
+		after = sample.brr_size(rate)
+		sizes_before[sample.name] = before
+		sizes_after[sample.name] = after
+		ceilingstr = "-" if ceiling is None else f"{ceiling:.0f}"
+		print(f"{sample.name:20s} rate {sample.rate:5d} -> {rate:5d} (needs {need:5.0f}, max {ceilingstr:>5s})  {before:6,d} -> {after:6,d} bytes")
+	print(f"Total: {sum(sizes_before.values()):,} -> {sum(sizes_after.values()):,} bytes")
+
+	# and what that does for each song, since it's the samples a song uses that have to fit
+	print()
+	inst_dat = build.get_instrument_data()
+	for song in build.get_songs():
+		used = set(build.get_instruments(song, inst_dat))
+		before = sum(i for name, i in sizes_before.items() if name in used)
+		after = sum(i for name, i in sizes_after.items() if name in used)
+		if before:
+			print(f"{song:40s} {before:6,d} -> {after:6,d} bytes of FM samples")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,519 @@
+#!/usr/bin/python
+# Render a song straight from its text file, for measuring levels, instead of building it with
+# AddMusicK and then recording the SPC through mpv.
+#   ./spcrender.py SONG.txt OUT.wav [SECONDS]
+# This doesn't emulate the SPC700 (in Python that'd never get anywhere near realtime), it plays
+# the MML the way AddMusicK's engine would, through a model of the S-DSP: BRR samples, pitch
+# from the instrument tuning, ADSR/GAIN envelopes, Gaussian interpolation, noise, and echo.
+# The engine side (volume/pan/velocity tables and so on) follows N-SPC, which AddMusicK is
+# built on, but it's not cycle-accurate, so treat the output as a close approximation.
+# Some of what the songs use isn't played at all, so any loudness measured from this leaves it out:
+#   $EE tuning, $DD pitch slides, p vibrato and $FB arpeggios (so the pitches are a little off,
+#   which makes next to no difference to loudness), $E1 pan fades, and the $F4 toggles; and
+#   $E3 tempo fades and $E8 volume fades jump straight to where they're going.
+import os
+import sys
+
+import numpy as np
+
+import aram
+import brr
+import build
+import dsp
+
+RATE = 32000
+# bump this whenever the output changes, so nothing stale gets picked out of anyone's cache
+VERSION = 2
+TICKS_PER_QUARTER = aram.TICKS // 4
+# the tempo is added to an 8-bit counter, one tick every overflow, this many times a second: it's
+# 500 in N-SPC, but AddMusicK's tempos come out at 2.5 BPM per t (t60 is 150 BPM), which is 512,
+# and every song's "single loop" time from its header agrees with that to within 0.1%
+TIMER_HZ = 512
+FIRST_CUSTOM_INSTRUMENT = 30
+
+# N-SPC tables, indexed by the two digits of q, and by y
+GATE_TABLE = [0x33, 0x66, 0x7F, 0x99, 0xB2, 0xCC, 0xE5, 0xFC]
+VELOCITY_TABLE = [0x19, 0x32, 0x4C, 0x65, 0x72, 0x7F, 0x8C, 0x98, 0xA5, 0xB2, 0xBF, 0xCB, 0xD8, 0xE5, 0xF2, 0xFC]
+PAN_TABLE = [0x00, 0x01, 0x03, 0x07, 0x0D, 0x15, 0x1E, 0x29, 0x34, 0x42, 0x51, 0x5E, 0x67, 0x6E, 0x73, 0x77, 0x7A, 0x7C, 0x7D, 0x7E, 0x7F]
+# AddMusicK's echo filter presets, for $F1
+FIR_PRESETS = [
+	[0x7F, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+	[0x58, 0xBF, 0xDB, 0xF0, 0xFE, 0x07, 0x0C, 0x0C],
+]
+# how many operand bytes follow each hex command (anything not here has none); $FB is variable
+HEX_OPERANDS = {
+	0xDA: 1, 0xDB: 1, 0xDC: 2, 0xDD: 3, 0xDE: 3, 0xE0: 1, 0xE1: 2, 0xE2: 1, 0xE3: 2, 0xE4: 1,
+	0xE5: 3, 0xE6: 1, 0xE7: 1, 0xE8: 2, 0xE9: 3, 0xEA: 1, 0xEB: 3, 0xEC: 3, 0xED: 2, 0xEE: 1,
+	0xEF: 3, 0xF1: 3, 0xF2: 3, 0xF3: 2, 0xF4: 1, 0xF5: 8, 0xF6: 2, 0xF8: 1, 0xF9: 2, 0xFA: 2,
+}
+
+# S-DSP envelope and noise rates, in samples per step (rate 0 never steps)
+RATE_PERIODS = [None, 2048, 1536, 1280, 1024, 768, 640, 512, 384, 320, 256, 192, 160, 128, 96, 80, 64, 48, 40, 32, 24, 20, 16, 12, 10, 8, 6, 5, 4, 3, 2, 1]
+ENV_MAX = 0x7FF
+RELEASE_STEP = 8
+ECHO_BLOCK = 512  # samples per step of the echo delay (16ms)
+
+def _gauss_table():
+	# the S-DSP's interpolation table is very close to a Gaussian with this width, scaled so each
+	# set of four taps adds up to 2048 (the hardware's own table isn't reproduced here)
+	sigma = 0.63
+	frac = np.arange(256) / 256
+	dist = np.stack([frac + 1, frac, 1 - frac, 2 - frac], axis=1)
+	weights = np.exp(-dist ** 2 / (2 * sigma ** 2))
+	return np.round(weights / weights.sum(axis=1, keepdims=True) * 2048)
+GAUSS = _gauss_table()
+
+def _noise_table():
+	# the 15-bit LFSR the noise generator steps through
+	res = np.empty(0x7FFF, dtype=np.int64)
+	lfsr = 0x4000
+	for i in range(len(res)):
+		feedback = (lfsr << 13 ^ lfsr << 14) & 0x4000
+		lfsr = feedback ^ (lfsr >> 1)
+		res[i] = lfsr
+	out = (res << 1) & 0xFFFF
+	return np.where(out >= 0x8000, out - 0x10000, out)
+NOISE = None
+
+class Instrument:
+	def __init__(self, name, adsr1, adsr2, gain, tuning):
+		self.name = name
+		self.adsr1 = adsr1
+		self.adsr2 = adsr2
+		self.gain = gain
+		self.tuning = tuning
+		data, loop_block = brr.read_brr(os.path.join("inst", name))
+		looping = bool(data[-brr.BLOCK_BYTES] & 2) if data else False
+		self.pcm = brr.decode(data).astype(np.float64)
+		self.loop = loop_block * brr.BLOCK_SAMPLES if looping else None
+
+def read_instruments(dat):
+	# the #instruments block, as Instruments in @30 onwards order
+	match = build.re_instruments.search(dat)
+	res = []
+	if not match:
+		return res
+	for line in match.group(1).split("\n"):
+		line = line.split(";", 1)[0].strip()
+		if not line:
+			continue
+		name, *vals = line.split()
+		vals = [int(i[1:], 16) for i in vals]
+		res.append(Instrument(name.strip('"'), vals[0], vals[1], vals[2], vals[3] + vals[4] / 256))
+	return res
+
+class Note:
+	__slots__ = ["start", "length", "release", "key", "inst", "noise", "volume", "pan", "velocity"]
+
+class Channel:
+	# walks the MML for one channel, collecting its notes
+	def __init__(self, song):
+		self.song = song
+		self.tick = 0
+		self.loop_tick = None
+		self.octave = 4
+		self.default = aram.TICKS // 8
+		self.triplet = False
+		self.transpose = 0
+		self.inst = None
+		self.noise = None
+		self.volume = 0xFF
+		self.pan = 10
+		self.gate = GATE_TABLE[7]
+		self.velocity = VELOCITY_TABLE[15]
+		self.notes = []
+		self.last = None  # the note a tie would extend
+
+	def ticks(self, length, dots):
+		return aram.note_ticks(length, dots, self.default, self.triplet, self.song.halvetempo)
+
+	# the octave, default length and triplets are all down to AddMusicK, not the engine, so a loop is
+	# compiled once with whatever they were where it's written, and every time it plays (or gets
+	# called from elsewhere) it plays the same, whatever they are at the time
+	def compile_state(self):
+		return self.octave, self.default, self.triplet
+
+	def set_compile_state(self, state):
+		self.octave, self.default, self.triplet = state
+
+	def play(self, items, labels):
+		ops = iter(items)
+		for item in ops:
+			if item[0] == "loop":
+				_, body, count, label = item
+				start = self.compile_state()
+				if label is not None:
+					self.song.label_state[label] = start
+				for _ in range(count):
+					self.set_compile_state(start)
+					self.play(body, labels)
+			elif item[0] == "call":
+				_, label, count = item
+				caller = self.compile_state()
+				for _ in range(count):
+					self.set_compile_state(self.song.label_state[label])
+					self.play(labels[label], labels)
+				self.set_compile_state(caller)
+			elif item[0] == "hex":
+				cmd = item[1]
+				if cmd == 0xFB:
+					# arpeggio: a count, then a duration, then that many notes
+					args = [next(ops)[1] for _ in range(2)]
+					args += [next(ops)[1] for _ in range(args[0])]
+				else:
+					args = [next(ops)[1] for _ in range(HEX_OPERANDS.get(cmd, 0))]
+				self.hex(cmd, args)
+			else:
+				self.token(item[1])
+
+	def hex(self, cmd, args):
+		song = self.song
+		if cmd == 0xFA and args[0] == 0x02:
+			self.transpose = args[1] - 256 if args[1] >= 0x80 else args[1]
+		elif cmd == 0xE2:
+			song.tempo.append((self.tick, args[0]))
+		elif cmd == 0xE3:
+			# tempo fades just jump straight to the new tempo
+			song.tempo.append((self.tick, args[1]))
+		elif cmd == 0xE0:
+			song.master.append((self.tick, args[0]))
+		elif cmd == 0xE7:
+			self.volume = args[0]
+		elif cmd == 0xE8:
+			self.volume = args[1]
+		elif cmd == 0xDB:
+			self.pan = min(args[0] & 0x1F, 20)
+		elif cmd == 0xED and self.inst is not None:
+			inst = self.inst
+			self.inst = Instrument.__new__(Instrument)
+			self.inst.__dict__.update(inst.__dict__, adsr1=args[0] | 0x80, adsr2=args[1])
+		elif cmd == 0xEF:
+			song.echo_mask = args[0]
+			song.echo_vol = (args[1], args[2])
+		elif cmd == 0xF0:
+			song.echo_mask = 0
+		elif cmd == 0xF1:
+			song.echo_delay, song.echo_feedback = args[0], args[1] - 256 if args[1] >= 0x80 else args[1]
+			song.echo_fir = FIR_PRESETS[args[2]] if args[2] < len(FIR_PRESETS) else FIR_PRESETS[0]
+		elif cmd == 0xF8:
+			self.noise = args[0] & 0x1F
+
+	def token(self, m):
+		text = m.group().strip()
+		if m["note"]:
+			ticks = self.ticks(m["length"], m["dots"])
+			if m["note"] == "r":
+				self.last = None
+			else:
+				note = "c d ef g a b".index(m["note"][0])
+				note += m["note"].count("+") - m["note"].count("-")
+				n = Note()
+				n.start = self.tick
+				n.length = ticks
+				n.release = ticks - ticks * self.gate // 256
+				n.key = 12 * (self.octave + 2) + note + self.transpose
+				n.inst = self.inst
+				n.noise = self.noise
+				n.volume = self.volume
+				n.pan = self.pan
+				n.velocity = self.velocity
+				self.notes.append(n)
+				self.last = n
+			self.tick += ticks
+		elif text.startswith("^"):
+			ticks = self.ticks(m["tielength"], m["tiedots"])
+			if self.last is not None:
+				self.last.length += ticks
+				self.last.release = ticks - ticks * self.gate // 256
+			self.tick += ticks
+		elif m["octave"]:
+			self.octave = int(m["octave"])
+		elif m["shift"]:
+			self.octave += 1 if m["shift"] == ">" else -1
+		elif m["transpose"]:
+			self.transpose = int(m["transpose"])
+		elif m["default"]:
+			self.default = aram.note_ticks(m["default"], m["defaultdots"], self.default, self.triplet, False)
+		elif m["triplet"]:
+			self.triplet = m["triplet"] == "{"
+		elif m["cmd"]:
+			args = [int(i) for i in m["args"].split(",")]
+			cmd = m["cmd"]
+			if cmd == "@":
+				if args[0] >= FIRST_CUSTOM_INSTRUMENT:
+					self.inst = self.song.instruments[args[0] - FIRST_CUSTOM_INSTRUMENT]
+				self.noise = None
+			elif cmd == "v":
+				self.volume = args[-1] if len(args) == 1 else args[1]
+			elif cmd == "y":
+				self.pan = min(args[0], 20)
+			elif cmd == "w":
+				self.song.master.append((self.tick, args[-1] if len(args) == 1 else args[1]))
+			elif cmd == "t":
+				self.song.tempo.append((self.tick, args[-1] if len(args) == 1 else args[1]))
+		elif m["quant"]:
+			q = int(m["quant"], 16)
+			self.gate = GATE_TABLE[(q >> 4) & 7]
+			self.velocity = VELOCITY_TABLE[q & 0xF]
+		elif m["noise"]:
+			self.noise = int(m["noise"], 16) & 0x1F
+		elif m["intro"]:
+			self.loop_tick = self.tick
+
+def parse(text):
+	# MML to nested lists of tokens per channel, with loops pulled out; also the labelled loops
+	channels = {0: []}
+	labels = {}
+	stack = [(channels[0], None, None)]
+	pos = 0
+	while pos < len(text):
+		if text[pos:].isspace():
+			break
+		m = aram.re_token.match(text, pos)
+		if not m:
+			line = text.count("\n", 0, pos) + 1
+			raise ValueError(f"Can't parse MML at line {line}: {text[pos:pos + 20]!r}")
+		pos = m.end()
+		items = stack[-1][0]
+		tok = m.group().strip()
+		if m["channel"]:
+			# anything before #0 (the w and t, usually) goes at the start of channel 0
+			ch = int(m["channel"])
+			channels.setdefault(ch, [])
+			stack = [(channels[ch], None, None)]
+		elif m["label"]:
+			if m["define"]:
+				stack.append(([], int(m["label"]), "]"))
+			else:
+				items.append(("call", int(m["label"]), int(m["callcount"] or 1)))
+		elif m["superstart"]:
+			stack.append(([], None, "]]"))
+		elif m["loopstart"]:
+			stack.append(([], None, "]"))
+		elif tok.startswith("]"):
+			body, label, close = stack.pop()
+			if not tok.startswith(close):
+				raise ValueError(f"Mismatched {tok[:len(close)]}")
+			count = m["supercount"] if close == "]]" else m["loopcount"]
+			if label is not None:
+				labels[label] = body
+			stack[-1][0].append(("loop", body, int(count or 1), label))
+		elif m["hex"]:
+			items.append(("hex", int(m["hex"], 16)))
+		else:
+			items.append(("token", m))
+	return channels, labels
+
+class Song:
+	def __init__(self, dat, master=None):
+		self.instruments = read_instruments(dat)
+		self.halvetempo = "#halvetempo" in dat.lower()
+		self.tempo = []
+		self.master = []
+		self.echo_mask = 0
+		self.echo_vol = (0, 0)
+		self.echo_delay = 0
+		self.echo_feedback = 0
+		self.echo_fir = FIR_PRESETS[0]
+		self.label_state = {}
+		channels, labels = parse(aram.strip_mml(dat))
+		self.channels = []
+		for ix in sorted(channels):
+			channel = Channel(self)
+			if self.channels:
+				# and that carries on from one channel into the next, too
+				channel.set_compile_state(self.channels[-1].compile_state())
+			channel.play(channels[ix], labels)
+			self.channels.append(channel)
+		self.length = max(channel.tick for channel in self.channels)
+		# channels that come out different lengths would drift apart every time the song loops,
+		# which is almost certainly a mistake in the MML (or in this)
+		lengths = {ix: channel.tick for ix, channel in zip(sorted(channels), self.channels) if channel.tick}
+		if len(set(lengths.values())) > 1:
+			raise ValueError(f"Channels are different lengths: {', '.join(f'#{ix} {ticks} ticks' for ix, ticks in lengths.items())}")
+		self.loop_tick = next((channel.loop_tick for channel in self.channels if channel.loop_tick is not None), 0)
+		if master is not None:
+			# render at a different w, without having to edit the file
+			self.master = [(0, master)]
+		self.tempo.sort(key=lambda i: i[0])
+		self.master.sort(key=lambda i: i[0])
+
+	def unroll(self, loops):
+		# the song's events, with the looped part repeated
+		looplen = self.length - self.loop_tick
+		end = self.length + (loops - 1) * looplen
+		def repeat(events):
+			res = list(events)
+			for i in range(1, loops):
+				res.extend((tick + i * looplen, val) for tick, val in events if tick >= self.loop_tick)
+			return res
+		tempo = repeat(self.tempo)
+		notes = []
+		for ch, channel in enumerate(self.channels):
+			for i in range(loops):
+				for note in channel.notes:
+					if i and note.start < self.loop_tick:
+						continue
+					notes.append((ch, note.start + i * looplen if i else note.start, note))
+		return end, tempo, repeat(self.master), notes
+
+def tick_times(tempo, halvetempo):
+	# tick -> seconds, from the tempo changes
+	ticks = np.array([0] + [tick for tick, _ in tempo], dtype=np.float64)
+	rates = [tempo[0][1] if tempo else 0x36] + [t for _, t in tempo]
+	rates = np.array([TIMER_HZ * (t / 2 if halvetempo else t) / 256 for t in rates])
+	starts = np.concatenate([[0], np.cumsum(np.diff(ticks) / rates[:-1])])
+	def convert(tick):
+		ix = np.searchsorted(ticks, tick, side="right") - 1
+		return starts[ix] + (tick - ticks[ix]) / rates[ix]
+	return convert
+
+def envelope(adsr1, adsr2, gain, keyon, total):
+	# envelope level (0..0x7FF) for each sample of a note, keyed off after keyon samples
+	env = np.empty(total)
+	level = 0.0
+	pos = 0
+	if adsr1 & 0x80:
+		attack = RATE_PERIODS[(adsr1 & 0x0F) * 2 + 1]
+		decay = RATE_PERIODS[((adsr1 >> 4) & 7) * 2 + 16]
+		sustain_level = ((adsr2 >> 5) + 1) * 0x100
+		sustain = RATE_PERIODS[adsr2 & 0x1F]
+		# attack: linear, in steps of 32 (or 1024 at the fastest rate)
+		step = 1024 if attack == 1 else 32
+		nsteps = -(-ENV_MAX // step)
+		n = min(keyon, nsteps * attack)
+		idx = np.arange(n)
+		env[:n] = np.minimum((idx // attack + 1) * step, ENV_MAX)
+		level = env[n - 1] if n else 0.0
+		pos = n
+		# decay then sustain: exponential, each step taking off 1/256 (plus one)
+		for period, floor_ in ((decay, sustain_level), (sustain, 0)):
+			if pos >= keyon or period is None:
+				break
+			# (level + 1) shrinks by 255/256 a step, so work out how many steps to reach the floor
+			if floor_:
+				steps = max(0, int(np.ceil(np.log((floor_ + 1) / (level + 1)) / np.log(255 / 256))))
+				n = min(keyon - pos, steps * period)
+			else:
+				n = keyon - pos
+			idx = np.arange(n)
+			env[pos:pos + n] = np.maximum((level + 1) * (255 / 256) ** (idx // period + 1) - 1, 0)
+			if n:
+				level = env[pos + n - 1]
+			pos += n
+		env[pos:keyon] = level
+	else:
+		# only direct gain; the other gain modes aren't used by any of the songs
+		level = (gain & 0x7F) * 16 if not gain & 0x80 else ENV_MAX
+		env[:keyon] = level
+		if keyon:
+			level = env[keyon - 1]
+	# release: straight down, 8 a sample
+	n = total - keyon
+	env[keyon:] = np.maximum(level - RELEASE_STEP * (np.arange(n) + 1), 0)
+	return env
+
+def voice(note, inst, pitch, nsamples, start_sample):
+	# one note through the BRR/noise source and Gaussian interpolation, before the envelope
+	if note.noise is not None:
+		global NOISE
+		if NOISE is None:
+			NOISE = _noise_table()
+		period = RATE_PERIODS[note.noise] or len(NOISE) * nsamples
+		return NOISE[((start_sample + np.arange(nsamples)) // period) % len(NOISE)].astype(np.float64)
+	counter = np.arange(nsamples, dtype=np.int64) * pitch
+	index = counter >> 12
+	frac = (counter >> 4) & 0xFF
+	pcm = inst.pcm
+	# the four samples around each position, following the loop round
+	taps = index[:, None] + np.arange(-3, 1)[None, :] + 3
+	padded = np.concatenate([np.zeros(3), pcm])
+	if inst.loop is not None:
+		loop = inst.loop + 3
+		looplen = len(padded) - loop
+		taps = np.where(taps >= len(padded), loop + (taps - loop) % looplen, taps)
+		values = padded[taps]
+	else:
+		values = np.where(taps < len(padded), padded[np.minimum(taps, len(padded) - 1)], 0)
+	weights = np.stack([GAUSS[255 - frac, 0], GAUSS[255 - frac, 1], GAUSS[frac, 2], GAUSS[frac, 3]], axis=1)
+	out = (values * weights).sum(axis=1) / 2048
+	if inst.loop is None:
+		# the voice stops at the end of a sample that doesn't loop
+		out[index >= len(pcm)] = 0
+	return np.clip(out, -32768, 32767)
+
+def mix_echo(echo_in, song):
+	# the echo buffer is fed back through the FIR filter; with the delay at least one 512 sample
+	# block, each block only depends on the ones before it, so a block can be done at once
+	delay = song.echo_delay * ECHO_BLOCK
+	if not delay:
+		return np.zeros_like(echo_in)
+	fir = np.array([i - 256 if i >= 0x80 else i for i in song.echo_fir], dtype=np.float64) / 128
+	n = len(echo_in)
+	buf = np.zeros((n + delay + 7, 2))
+	out = np.zeros_like(echo_in)
+	for base in range(0, n, delay):
+		end = min(base + delay, n)
+		# what comes out now is what went in delay samples ago, filtered
+		src = buf[base:end + 7]
+		filtered = sum(fir[k] * src[k:k + end - base] for k in range(8))
+		out[base:end] = filtered
+		buf[base + delay + 7:end + delay + 7] = echo_in[base:end] + filtered * song.echo_feedback / 128
+	return out
+
+def render_song(dat, seconds=None, loops=1, master=None):
+	# returns 16-bit stereo samples at RATE
+	song = Song(dat, master)
+	end, tempo, masters, notes = song.unroll(loops)
+	to_seconds = tick_times(tempo, song.halvetempo)
+	total = int(np.ceil(to_seconds(end) * RATE))
+	if seconds is not None:
+		total = min(total, round(seconds * RATE))
+	main = np.zeros((total, 2))
+	echo = np.zeros((total, 2)) if song.echo_mask else None
+	master_ticks = np.array([tick for tick, _ in masters] or [0])
+	master_vals = [w for _, w in masters] or [0xC0]
+
+	# each note runs until the channel's next note takes the voice over
+	bychannel = {}
+	for ch, start, note in notes:
+		bychannel.setdefault(ch, []).append((start, note))
+	for ch, chnotes in bychannel.items():
+		chnotes.sort(key=lambda i: i[0])
+		for i, (start, note) in enumerate(chnotes):
+			inst = note.inst
+			if inst is None:
+				continue
+			s0 = round(to_seconds(start) * RATE)
+			if s0 >= total:
+				break
+			keyoff = round(to_seconds(start + note.length - note.release) * RATE)
+			limit = round(to_seconds(chnotes[i + 1][0]) * RATE) if i + 1 < len(chnotes) else total
+			limit = min(limit, total)
+			nsamples = min(limit, keyoff + ENV_MAX // RELEASE_STEP + 1) - s0
+			if nsamples <= 0:
+				continue
+			freq = 440 * 2 ** ((note.key - 69) / 12)
+			pitch = min(round(4096 * freq * inst.tuning * 8 / RATE), 0x3FFF)
+			env = envelope(inst.adsr1, inst.adsr2, inst.gain, min(keyoff - s0, nsamples), nsamples)
+			out = voice(note, inst, pitch, nsamples, s0) * env / 2048
+			# volume: velocity, channel and master volumes multiplied together, then squared
+			w = master_vals[np.searchsorted(master_ticks, start, side="right") - 1]
+			level = (note.velocity / 256 * note.volume / 256 * w / 256) ** 2
+			vols = np.array([PAN_TABLE[20 - note.pan], PAN_TABLE[note.pan]]) / 0x80 * level
+			main[s0:s0 + nsamples] += out[:, None] * vols[None, :]
+			if echo is not None and song.echo_mask & (1 << ch):
+				echo[s0:s0 + nsamples] += out[:, None] * vols[None, :]
+	if echo is not None:
+		evol = np.array([i - 256 if i >= 0x80 else i for i in song.echo_vol]) / 128
+		main += mix_echo(echo, song) * evol[None, :]
+	return np.clip(np.round(main), -32768, 32767).astype("<i2")
+
+def main():
+	with open(sys.argv[1]) as fp:
+		dat = fp.read()
+	seconds = float(sys.argv[3]) if len(sys.argv) > 3 else None
+	dsp.write_wav(sys.argv[2], render_song(dat, seconds) / 32768, RATE)
+
+if __name__ == "__main__":
+	main()
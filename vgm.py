@@ -1,3 +1,5 @@
+from array import array
+from bisect import bisect_left, bisect_right
 import struct
 from dataclasses import dataclass
 
@@ -78,17 +80,72 @@ def read_gd3(fp):
 	assert len(dat) == 12 and not dat[-1]
 	return GD3(*dat[:-1])
 
-def read_commands(fp, hdr):
-	framenum = 0
-	cur_frame = Frame(0, [], [])
+class FrameIndex:
+	# Where each frame read_commands finds is, to answer "what's playing at sample N" without
+	# walking the whole frame list, and to start reading partway through a file.
+	#   sample: the sample each frame starts on, in order
+	#   offset: where in the file its commands start
+	#   ym, psg: how many events of each there were before it (with one extra on the end, the totals)
+	def __init__(self):
+		self.sample = array("q")
+		self.offset = array("q")
+		self.ym = array("q", [0])
+		self.psg = array("q", [0])
+
+	def __len__(self):
+		return len(self.sample)
+
+	def add_frame(self, sample, offset):
+		self.sample.append(sample)
+		self.offset.append(offset)
+		self.ym.append(self.ym[-1])
+		self.psg.append(self.psg[-1])
+
+	def end_frame(self, frame):
+		self.ym[-1] += len(frame.ym)
+		self.psg[-1] += len(frame.psg)
+
+	def frame_at(self, sample):
+		# the index of the frame playing at the given sample
+		return max(bisect_right(self.sample, sample) - 1, 0)
+
+	def offset_at(self, sample):
+		return self.offset[self.frame_at(sample)]
+
+	def frame_range(self, start, end):
+		# the frames that play any of the samples from start up to (but not including) end
+		return range(self.frame_at(start), bisect_left(self.sample, end))
+
+	def event_range(self, start, end):
+		# which of the YM and PSG events, counting from the start of the song, happen from start up
+		# to (but not including) end, as (range of YM events, range of PSG events)
+		frames = self.frame_range(start, end)
+		return range(self.ym[frames.start], self.ym[frames.stop]), range(self.psg[frames.start], self.psg[frames.stop])
+
+def seek(fp, index, sample):
+	# move to the start of the frame playing at the given sample, ready for read_commands to
+	# carry on from there, and return the sample that frame starts on
+	ix = index.frame_at(sample)
+	fp.seek(index.offset[ix])
+	return index.sample[ix]
+
+def read_commands(fp, hdr, index=None, framenum=0):
+	# framenum is the sample the file is at, if it isn't the start of the song (see seek)
+	cur_frame = Frame(framenum, [], [])
 	frames = [cur_frame]
-	have_looped = False
+	have_looped = bool(hdr.loopofs) and hdr.loopofs < fp.tell()
+	if index is not None:
+		index.add_frame(framenum, fp.tell())
 
 	def newframe(delay):
 		nonlocal framenum, cur_frame, frames
+		if index is not None:
+			index.end_frame(cur_frame)
 		framenum += delay
 		cur_frame = Frame(framenum, [], [])
 		frames.append(cur_frame)
+		if index is not None:
+			index.add_frame(framenum, fp.tell())
 
 	while True:
 		if not have_looped and hdr.loopofs and hdr.loopofs <= fp.tell():
@@ -113,9 +170,11 @@ def read_commands(fp, hdr):
 			case _:
 				raise ValueError(f"Unhandled opcode {op:02X}")
 	assert framenum == hdr.samplelen
+	if index is not None:
+		index.end_frame(cur_frame)
 	return frames
 
-def read_file(fp):
+def read_file(fp, index=None):
 	ofs = fp.tell()
 	hdr = read_header(fp)
 	if hdr.gd3:
@@ -124,4 +183,4 @@ def read_file(fp):
 	else:
 		gd3 = None
 	fp.seek(ofs + 0x40)
-	return hdr, gd3, read_commands(fp, hdr)
+	return hdr, gd3, read_commands(fp, hdr, index)
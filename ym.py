@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import heapq
 import math
 import os
 import struct
@@ -108,6 +109,8 @@ def imap(inst):
 		song_instrumentnotes[inst] = []
 	return song_instrumentmap[inst]
 
+RENDER_WAVS = True
+
 INST_31 = (1, 3, 18, 97, 21, 28, 24, 17, 150, 26, 216, 21, 1, 1, 6, 131, 3, 1, 1, 13, 63, 47, 15, 15, 0, 0, 0, 0, 61, 210, 15)
 INST_43 = (51, 48, 114, 0, 36, 17, 25, 9, 0, 5, 6, 15, 24, 2, 25, 4, 12, 5, 6, 6, 9, 3, 3, 100, 0, 0, 0, 0, 59, 227, 14)
 
@@ -204,6 +207,8 @@ def write_instrument(fp, ix, inst, dn):
 SLOTS = [[3], [3], [3], [3], [1,3], [1,2,3], [1,2,3], [0,1,2,3]]
 
 def gen_instrument_wav(ix, inst, notevals, dn, notelen=RATE*3, breaklen=RATE, extralen=RATE):
+	if not RENDER_WAVS:
+		return
 	with open("__tmpinst.vgm", "wb") as fp:
 		def writedelay(length):
 			sec, samp = divmod(length, RATE)
@@ -313,12 +318,66 @@ def from_note(note):
 	freq = round(BASE_NOTE * 2**(note/12))
 	return int(octave) << 11 | freq
 
+# split up each instrument's notes into separate voices, each on its own track, rather than
+# having one track per instrument
+SPLIT_VOICES = False
+# how many semitones' jump a change in stereo counts as, when working out which voice a note
+# carries on from
+STEREO_COST = 12
+# and a note that'd be more of a jump than this from every free voice starts a new one
+NEW_VOICE_COST = 12
+
+def split_voices(ym):
+	# which voice of its instrument each NoteOn is, in order
+	# each instrument's notes are dealt out in the order they start, to whichever voice that's
+	# free by then they'd be the smoothest continuation of, with the busy ones in a heap by when
+	# they finish, so the whole thing is O(n log n)
+	notes = []
+	curr_note = [None] * 6
+	for ev in ym:
+		if isinstance(ev, NoteOn):
+			curr_note[ev.channel] = [ev.frame, None, ev.inst, round(note(ev.freq)), ev.stereo]
+			notes.append(curr_note[ev.channel])
+		elif isinstance(ev, NoteOff):
+			curr_note[ev.channel][1] = ev.frame
+	res = []
+	busy = {}  # inst: heap of (end frame, voice, pitch, stereo)
+	free = {}  # inst: {voice: (pitch, stereo)} of where each voice left off
+	for start, end, inst, pitch, stereo in notes:
+		heap = busy.setdefault(inst, [])
+		idle = free.setdefault(inst, {})
+		while heap and heap[0][0] <= start:
+			_, voice, last_pitch, last_stereo = heapq.heappop(heap)
+			idle[voice] = last_pitch, last_stereo
+		def cost(voice):
+			last_pitch, last_stereo = idle[voice]
+			return abs(pitch - last_pitch) + (STEREO_COST if stereo != last_stereo else 0), voice
+		voice = min(idle, key=cost, default=None)
+		if voice is None or cost(voice)[0] > NEW_VOICE_COST:
+			voice = len(heap) + len(idle)
+		else:
+			del idle[voice]
+		heapq.heappush(heap, (end, voice, pitch, stereo))
+		res.append(voice)
+	return res
+
 def ym_to_midi(hdr, ym):
+	if SPLIT_VOICES:
+		voices = split_voices(ym)
+		trackmap = {}
+		for ev, voice in zip((ev for ev in ym if isinstance(ev, NoteOn)), voices):
+			trackmap.setdefault((song_instrumentmap[ev.inst], voice), None)
+		trackmap.update(((tr, 0), None) for tr in range(len(song_instrumentlist)))
+		trackmap = {key: ix for ix, key in enumerate(sorted(trackmap))}
+		voices = iter(voices)
+	else:
+		trackmap = {(tr, 0): tr for tr in range(len(song_instrumentlist))}
 	tracks = []
-	for tr, inst in enumerate(song_instrumentlist):
-		instix = all_instrumentmap[inst]
+	for tr, voice in trackmap:
+		instix = all_instrumentmap[song_instrumentlist[tr]]
+		name = f"FM {tr} ({instix})" if (tr, 1) not in trackmap else f"FM {tr} ({instix}) voice {voice}"
 		tracks.append([
-			midifile.TimedMidiEvent(0, midifile.MetaEvent(midifile.Events.TRACK_NAME, f"FM {tr} ({instix})".encode("utf-8"))),
+			midifile.TimedMidiEvent(0, midifile.MetaEvent(midifile.Events.TRACK_NAME, name.encode("utf-8"))),
 		])
 	for ch in range(6):
 		tracks[0].extend(midifile.TimedMidiEvent(0, ev) for ev in midifile.param_change(ch, midifile.Params.PARAM_PITCH_BEND_SENSITIVITY, MAX_BEND, 0))
@@ -326,12 +385,13 @@ def ym_to_midi(hdr, ym):
 	for ev in ym:
 		if isinstance(ev, NoteOn):
 			assert not curr_note[ev.channel]
-			tr = song_instrumentmap[ev.inst]
+			instno = song_instrumentmap[ev.inst]
+			tr = trackmap[instno, next(voices) if SPLIT_VOICES else 0]
 			n = note(ev.freq)
 			rn = round(n)
 			nofs = n - rn
 			tracks[tr].append(midifile.TimedMidiEvent(ev.frame, midifile.Wheel(ev.channel, round((nofs/MAX_BEND + 1) * 8192))))
-			tracks[tr].append(midifile.TimedMidiEvent(ev.frame, midifile.Program(ev.channel, tr)))
+			tracks[tr].append(midifile.TimedMidiEvent(ev.frame, midifile.Program(ev.channel, instno)))
 			tracks[tr].append(midifile.TimedMidiEvent(ev.frame, midifile.Control(ev.channel, 10, [64, 127, 0, 64][ev.stereo])))
 			tracks[tr].append(midifile.TimedMidiEvent(ev.frame, midifile.NoteOn(ev.channel, rn, 64)))
 			curr_note[ev.channel] = tr, rn
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import struct
+import zlib
+import zipfile
+
+# Zip writing for build.py, where the same files (samples, mostly) go into lots of archives.
+# Each file is deflated once, and the compressed data kept in CACHE under the hash of its
+# contents, to be copied straight into every archive it's needed in, this run or any later one.
+# zipfile has no way to add already-compressed data, so the archive itself is written here;
+# it's the same deflate stream, and the same metadata, that ZipFile.write would produce.
+
+CACHE = "build/zipcache"
+LEVEL = 9
+
+def _content_hash(data):
+	return hashlib.sha256(data).hexdigest()
+
+def compressed(data):
+	# raw deflate stream for some file contents, from the cache if we've done it before
+	fn = os.path.join(CACHE, f"{_content_hash(data)}.{LEVEL}")
+	try:
+		with open(fn, "rb") as fp:
+			return fp.read()
+	except FileNotFoundError:
+		pass
+	comp = zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+	res = comp.compress(data) + comp.flush()
+	os.makedirs(CACHE, exist_ok=True)
+	# several builds can be racing to cache the same file, so never leave a partial one behind
+	tmpfn = f"{fn}.{os.getpid()}"
+	with open(tmpfn, "wb") as fp:
+		fp.write(res)
+	os.replace(tmpfn, fn)
+	return res
+
+def prime(fn):
+	# compress a file into the cache ahead of time, so the archives can all be put together in parallel
+	with open(fn, "rb") as fp:
+		compressed(fp.read())
+
+def _dos_datetime(date_time):
+	year, month, day, hour, minute, second = date_time
+	return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+def write_zip(zipfn, members):
+	# members: (filename, name in archive) pairs
+	out = bytearray()
+	central = bytearray()
+	for fn, arcname in members:
+		info = zipfile.ZipInfo.from_file(fn, arcname)
+		with open(fn, "rb") as fp:
+			data = fp.read()
+		comp = compressed(data)
+		crc = zlib.crc32(data)
+		name = arcname.encode("ascii")
+		dostime, dosdate = _dos_datetime(info.date_time)
+		offset = len(out)
+		out += struct.pack("<4sHHHHHLLLHH", b"PK\x03\x04", 20, 0, zipfile.ZIP_DEFLATED, dostime, dosdate, crc, len(comp), len(data), len(name), 0)
+		out += name
+		out += comp
+		central += struct.pack("<4sBBHHHHHLLLHHHHHLL", b"PK\x01\x02", 20, info.create_system, 20, 0, zipfile.ZIP_DEFLATED, dostime, dosdate, crc, len(comp), len(data), len(name), 0, 0, 0, 0, info.external_attr, offset)
+		central += name
+	end = struct.pack("<4sHHHHLLH", b"PK\x05\x06", 0, 0, len(members), len(members), len(central), len(out), 0)
+	tmpfn = f"{zipfn}.tmp"
+	with open(tmpfn, "wb") as fp:
+		fp.write(out + central + end)
+	os.replace(tmpfn, zipfn)